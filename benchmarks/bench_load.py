@@ -0,0 +1,118 @@
+"""
+Compares the filesystem calls and wall time of loading an envdir with the
+scandir based loader of :class:`envdir.Env` against the previous
+``os.walk`` based implementation.
+
+Usage::
+
+    python benchmarks/bench_load.py [number of variables]
+"""
+
+import functools
+import os
+import sys
+import timeit
+
+try:
+    import builtins
+except ImportError:  # <python3
+    import __builtin__ as builtins
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from envdir.env import Env, isenvvar  # noqa: E402
+from fixtures import make_envdir, remove_envdir  # noqa: E402
+
+
+def legacy_load(path):
+    """
+    The loader as it was before the scandir rewrite: an os.walk, two stats
+    and a text mode open per variable.
+    """
+    values = {}
+    for _, _, files in os.walk(path, followlinks=True):
+        for name in filter(isenvvar, files):
+            file_path = os.path.join(path, name)
+            if os.stat(file_path).st_size == 0:
+                continue
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path) as var:
+                values[name] = var.read().strip("\n").replace("\x00", "\n")
+    return values
+
+
+class CallCounter(object):
+    """
+    Wraps the os level functions used to read an envdir and counts how
+    often each of them was called. Each of them is one system call, except
+    for the builtin ``open``: opening, reading and closing a file in text
+    mode costs openat, fstat, ioctl, lseek, two reads and a close on Linux.
+    """
+
+    names = ["open", "read", "fstat", "close", "stat", "scandir", "listdir"]
+    weights = {"builtin open": 7}
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.names + ["builtin open"], 0)
+        self.originals = {}
+
+    def wrap(self, module, name, key):
+        original = getattr(module, name)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            self.counts[key] += 1
+            return original(*args, **kwargs)
+
+        self.originals[(module, name)] = original
+        setattr(module, name, wrapper)
+
+    def __enter__(self):
+        for name in self.names:
+            if hasattr(os, name):
+                self.wrap(os, name, name)
+        self.wrap(builtins, "open", "builtin open")
+        return self
+
+    def __exit__(self, *exc_info):
+        for (module, name), original in self.originals.items():
+            setattr(module, name, original)
+
+
+def main(count=500):
+    path = make_envdir(count)
+    saved = os.environ.copy()
+    try:
+        for label, load in [
+            ("os.walk loader", lambda: legacy_load(path)),
+            ("scandir loader", lambda: Env(path).clear()),
+        ]:
+            with CallCounter() as counter:
+                load()
+            calls = sum(
+                counter.weights.get(name, 1) * number
+                for name, number in counter.counts.items()
+            )
+            seconds = min(timeit.repeat(load, number=5, repeat=3)) / 5
+            print(
+                "%-16s %6.2f syscalls/var  %8.3f ms/load  %s"
+                % (
+                    label,
+                    calls / float(count),
+                    seconds * 1000,
+                    ", ".join(
+                        "%s=%d" % item
+                        for item in sorted(counter.counts.items())
+                        if item[1]
+                    ),
+                )
+            )
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        remove_envdir(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,91 @@
+"""
+Compares the peak memory allocated by Python, as measured by tracemalloc,
+and the wall time of loading an envdir of large values (PEM bundles and
+JSON blobs of hundreds of KB, 10 MB in total by default) with and without
+memory mapping the files, see ``envdir.env.MMAP_THRESHOLD``. Most of the
+peak are the loaded values themselves (and their copies in os.environ),
+the copies made while reading a file show in the peak above them.
+
+Usage::
+
+    python benchmarks/bench_mmap.py [total size in MB]
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import envdir.env  # noqa: E402
+from envdir.env import Env  # noqa: E402
+
+# the size of every single value
+VALUE_SIZE = 256 * 1024
+
+
+def make_large_envdir(total):
+    root = tempfile.mkdtemp(prefix="envdir-bench-")
+    path = os.path.join(root, "envdir")
+    os.mkdir(path)
+    pem = (
+        "-----BEGIN CERTIFICATE-----\n"
+        + "MIIDdzCCAl+gAwIBAgIEAgAAuTANBgkqhkiG9w0BAQUFADBaMQswCQYDVQQGEwJJ\n" * 64
+        + "-----END CERTIFICATE-----\n"
+    )
+    blob = json.dumps(dict(("key%d" % index, "x" * 50) for index in range(4000)))
+    for index in range(int(total // VALUE_SIZE)):
+        if index % 2:
+            # NUL separated lines, as written by envdir for multiline values
+            content = (pem * (VALUE_SIZE // len(pem) + 1))[:VALUE_SIZE]
+            content = content.replace("\n", "\0") + "\n"
+        else:
+            content = (blob * (VALUE_SIZE // len(blob) + 1))[:VALUE_SIZE] + "\n"
+        with open(os.path.join(path, "LARGE_%03d" % index), "w") as var:
+            var.write(content)
+    return path
+
+
+def measure(path, threshold):
+    envdir.env.MMAP_THRESHOLD = threshold
+    tracemalloc.start()
+    start = time.time()
+    env = Env(path)
+    elapsed = time.time() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    values = dict(env.data)
+    env.clear()
+    return retained, peak, elapsed, values
+
+
+def mb(size):
+    return size / 1024.0 / 1024.0
+
+
+def main(total=10):
+    path = make_large_envdir(total * 1024 * 1024)
+    saved = os.environ.copy()
+    default = envdir.env.MMAP_THRESHOLD
+    try:
+        results = {}
+        for name, threshold in [("read", sys.maxsize), ("mmap", default)]:
+            retained, peak, elapsed, results[name] = measure(path, threshold)
+            print(
+                "%-5s peak %6.1f MB, %6.2f MB above the retained values  %7.1f ms"
+                % (name, mb(peak), mb(peak - retained), elapsed * 1000)
+            )
+        assert results["read"] == results["mmap"]
+    finally:
+        envdir.env.MMAP_THRESHOLD = default
+        os.environ.clear()
+        os.environ.update(saved)
+        shutil.rmtree(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,54 @@
+"""
+Compares loading an envdir with loading the pack made of it by ``envdir
+pack``, see :mod:`envdir.pack`, and checks that both result in the same
+variables.
+
+Usage::
+
+    python benchmarks/bench_pack.py [number of variables]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_envdir, remove_envdir  # noqa: E402
+from envdir.env import Env  # noqa: E402
+from envdir.pack import pack  # noqa: E402
+
+REPEAT = 20
+NUMBER = 5
+
+
+def main(count=800):
+    path = make_envdir(count, ["small", "multiline", "null"])
+    packed = os.path.join(os.path.dirname(path), "env.pack")
+    saved = os.environ.copy()
+    try:
+        pack(path, packed)
+        with Env(path, apply=False) as directory, Env(packed, apply=False) as env:
+            assert directory.data == env.data
+        loads = [
+            ("envdir", lambda: Env(path).clear()),
+            ("pack", lambda: Env(packed).clear()),
+        ]
+        timings = dict((name, []) for name, _ in loads)
+        # interleaved, so that e.g. warming up doesn't favor one of them
+        for _ in range(REPEAT):
+            for name, load in loads:
+                timings[name].append(timeit.timeit(load, number=NUMBER) / NUMBER)
+        for name, _ in loads:
+            print(
+                "%-6s %8.3f ms/load  (%d variables)"
+                % (name, min(timings[name]) * 1000, count)
+            )
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        remove_envdir(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,79 @@
+"""
+Compares starting many children of a process which opened an envdir with
+subprocess, with os.posix_spawn passing os.environ and with
+:meth:`envdir.Env.spawn`, which reuses the environment built once by
+:meth:`envdir.Env.as_exec_env`.
+
+Usage::
+
+    python benchmarks/bench_spawn.py [number of children] [number of variables]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_envdir, remove_envdir  # noqa: E402
+from envdir.env import Env  # noqa: E402
+
+# reaping children in batches keeps the number of processes bounded
+BATCH = 100
+
+
+def wait_pid(pid):
+    os.waitpid(pid, 0)
+
+
+def spawn_subprocess(env, argv):
+    return subprocess.Popen(argv)
+
+
+def wait_subprocess(process):
+    process.wait()
+
+
+def spawn_environ(env, argv):
+    return os.posix_spawn(argv[0], argv, os.environ)
+
+
+def spawn_env(env, argv):
+    return env.spawn(argv)
+
+
+def main(children=10000, count=100):
+    if not hasattr(os, "posix_spawn"):
+        sys.exit("os.posix_spawn is not available")
+    path = make_envdir(count, ["small", "multiline"])
+    saved = os.environ.copy()
+    argv = ["/bin/true"]
+    try:
+        with Env(path) as env:
+            for name, spawn, wait in [
+                ("subprocess.Popen", spawn_subprocess, wait_subprocess),
+                ("os.posix_spawn", spawn_environ, wait_pid),
+                ("Env.spawn", spawn_env, wait_pid),
+            ]:
+                elapsed = 0
+                for start in range(0, children, BATCH):
+                    spawned = []
+                    begin = time.time()
+                    for _ in range(min(BATCH, children - start)):
+                        spawned.append(spawn(env, argv))
+                    elapsed += time.time() - begin
+                    for child in spawned:
+                        wait(child)
+                print(
+                    "%-16s %8.1f us/child  (%d children, %d variables)"
+                    % (name, elapsed / children * 1e6, children, count)
+                )
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        remove_envdir(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
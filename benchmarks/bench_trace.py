@@ -0,0 +1,59 @@
+"""
+Compares the time of loading an envdir without the tracing hooks at all,
+with tracing disabled (the default) and with tracing enabled, see
+``Env(path, trace=True)`` and ``ENVDIR_TRACE``.
+
+Usage::
+
+    python benchmarks/bench_trace.py [number of variables]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_envdir, remove_envdir  # noqa: E402
+from envdir.env import Env  # noqa: E402
+
+REPEAT = 20
+NUMBER = 5
+
+
+class Untraced(Env):
+    "Env without the check for a tracer when loading"
+
+    def _load(self):
+        self._load_values()
+
+
+def main(count=1000):
+    path = make_envdir(count)
+    saved = os.environ.copy()
+    try:
+        loads = [
+            ("untraced", lambda: Untraced(path).clear()),
+            ("disabled", lambda: Env(path).clear()),
+            ("enabled", lambda: Env(path, trace=True).clear()),
+        ]
+        timings = dict((name, []) for name, _ in loads)
+        # interleaved, so that e.g. warming up doesn't favor one of them
+        for _ in range(REPEAT):
+            for name, load in loads:
+                timings[name].append(timeit.timeit(load, number=NUMBER) / NUMBER)
+        for name, _ in loads:
+            timings[name] = min(timings[name])
+            print("%-9s %8.3f ms/load" % (name, timings[name] * 1000))
+        print(
+            "overhead of disabled tracing: %+.2f%%"
+            % ((timings["disabled"] / timings["untraced"] - 1) * 100)
+        )
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        remove_envdir(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
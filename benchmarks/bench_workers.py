@@ -0,0 +1,67 @@
+"""
+Compares loading an envdir serially and with a pool of reader threads on
+a simulated network filesystem, on which every open of a file takes a
+fixed round trip time.
+
+Usage::
+
+    python benchmarks/bench_workers.py [number of variables] [latency in ms]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_envdir, remove_envdir  # noqa: E402
+from envdir.env import Env  # noqa: E402
+
+
+class Latency(object):
+    """
+    Delays every os.open below a directory by the given number of seconds,
+    releasing the GIL like a blocking system call would.
+    """
+
+    def __init__(self, root, seconds):
+        self.root = root
+        self.seconds = seconds
+        self.original = os.open
+
+    def open(self, path, *args, **kwargs):
+        if path.startswith(self.root):
+            time.sleep(self.seconds)
+        return self.original(path, *args, **kwargs)
+
+    def __enter__(self):
+        os.open = self.open
+        return self
+
+    def __exit__(self, *exc_info):
+        os.open = self.original
+
+
+def main(count=1000, latency=1.0):
+    path = make_envdir(count)
+    saved = os.environ.copy()
+    try:
+        with Env(path) as env:
+            expected = dict(env.data)
+        with Latency(path, latency / 1000.0):
+            for workers in [1, 4, 16, 64]:
+                start = time.time()
+                with Env(path, workers=workers) as env:
+                    assert env.data == expected
+                print(
+                    "%3d workers  %8.1f ms/load"
+                    % (workers, (time.time() - start) * 1000)
+                )
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        remove_envdir(path)
+
+
+if __name__ == "__main__":
+    main(*[float(arg) if "." in arg else int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,50 @@
+"""
+Synthetic envdirs for the benchmarks.
+"""
+
+import os
+import tempfile
+
+# the kinds of values of the generated variables, each kind is used for
+# the same share of the variables
+KINDS = ["small", "large", "multiline", "null", "symlink"]
+
+
+def value(kind, index):
+    if kind == "small":
+        return "value-%d\n" % index
+    if kind == "large":
+        return ("%d" % index) * (8 * 1024 // len("%d" % index)) + "\n"
+    if kind == "multiline":
+        return "\n".join("line %d of %d" % (line, index) for line in range(20))
+    if kind == "null":
+        return "null\x00separated\x00%d\n" % index
+    raise ValueError(kind)
+
+
+def make_envdir(count, kinds=("small",), root=None):
+    """
+    Creates a temporary envdir with count variables, cycling through the
+    given kinds of values. Symlinks point to a file outside of the envdir.
+    """
+    path = tempfile.mkdtemp(prefix="envdir-bench-", dir=root)
+    envdir = os.path.join(path, "envdir")
+    os.mkdir(envdir)
+    target = os.path.join(path, "symlink-target")
+    with open(target, "w") as var:
+        var.write("symlinked\n")
+    for index in range(count):
+        kind = kinds[index % len(kinds)]
+        name = os.path.join(envdir, "VAR_%s_%05d" % (kind.upper(), index))
+        if kind == "symlink":
+            os.symlink(target, name)
+        else:
+            with open(name, "w") as var:
+                var.write(value(kind, index))
+    return envdir
+
+
+def remove_envdir(envdir):
+    import shutil
+
+    shutil.rmtree(os.path.dirname(envdir))
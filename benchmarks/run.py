@@ -0,0 +1,203 @@
+"""
+The benchmark suite of envdir's hot paths: loading envdirs of 10 to 10,000
+variables of various kinds, bulk writes, clearing and the startup of the
+envdir command. Uses pyperf if it is installed, otherwise a simple runner
+printing the best and mean time of a few repetitions.
+
+Every benchmark is a function taking a number of loops and returning the
+seconds those loops took, like pyperf's ``bench_time_func`` expects.
+
+Usage::
+
+    python benchmarks/run.py [--quick] [pyperf options]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import envdir  # noqa: E402
+from envdir.env import Env  # noqa: E402
+from fixtures import KINDS, make_envdir, remove_envdir  # noqa: E402
+
+try:
+    perf_counter = time.perf_counter
+except AttributeError:  # <python3.3
+    perf_counter = time.time
+
+SIZES = [10, 100, 1000, 10000]
+QUICK_SIZES = [10, 1000]
+
+
+def bench_load(path):
+    "Env._load, through instantiating Env"
+
+    def load(loops):
+        elapsed = 0
+        for _ in range(loops):
+            start = perf_counter()
+            env = Env(path)
+            elapsed += perf_counter() - start
+            env.clear()
+        return elapsed
+
+    return load
+
+
+def bench_open(path):
+    "envdir.open, including the checks of the path"
+
+    def open(loops):
+        elapsed = 0
+        for _ in range(loops):
+            start = perf_counter()
+            env = envdir.open(path)
+            elapsed += perf_counter() - start
+            env.clear()
+        return elapsed
+
+    return open
+
+
+def bench_read_only(path):
+    "envdir.read_only, without touching os.environ"
+
+    def read_only(loops):
+        start = perf_counter()
+        for _ in range(loops):
+            envdir.read_only(path)
+        return perf_counter() - start
+
+    return read_only
+
+
+def bench_clear(path):
+    "Env.clear, resetting os.environ"
+
+    def clear(loops):
+        elapsed = 0
+        for _ in range(loops):
+            env = Env(path)
+            start = perf_counter()
+            env.clear()
+            elapsed += perf_counter() - start
+        return elapsed
+
+    return clear
+
+
+def bench_setitem(path, count):
+    "Env.__setitem__, writing count variables one by one"
+    values = [("WRITTEN_%05d" % index, "written") for index in range(count)]
+
+    def setitem(loops):
+        env = Env(path)
+        start = perf_counter()
+        for _ in range(loops):
+            for name, value in values:
+                env[name] = value
+        elapsed = perf_counter() - start
+        env.clear()
+        return elapsed
+
+    return setitem
+
+
+def bench_update(path, count):
+    "Env.update, writing count variables in one transaction"
+    values = dict(("UPDATED_%05d" % index, "updated") for index in range(count))
+
+    def update(loops):
+        env = Env(path)
+        start = perf_counter()
+        for _ in range(loops):
+            env.update(values)
+        elapsed = perf_counter() - start
+        env.clear()
+        return elapsed
+
+    return update
+
+
+def bench_startup(path):
+    "python -m envdir DIR true, end to end"
+    command = [sys.executable, "-m", "envdir", path, "true"]
+
+    def startup(loops):
+        start = perf_counter()
+        for _ in range(loops):
+            subprocess.check_call(command, cwd=ROOT)
+        return perf_counter() - start
+
+    return startup
+
+
+def benchmarks(sizes, paths):
+    """
+    Returns (name, function) pairs of all benchmarks, creating the envdirs
+    they need and adding them to paths.
+    """
+    result = []
+    for size in sizes:
+        path = make_envdir(size, KINDS)
+        paths.append(path)
+        result.append(("load-%d" % size, bench_load(path)))
+        result.append(("open-%d" % size, bench_open(path)))
+        result.append(("read_only-%d" % size, bench_read_only(path)))
+        result.append(("clear-%d" % size, bench_clear(path)))
+        if sys.platform != "win32":
+            # without large values, to stay below the limits of execve
+            path = make_envdir(size, [kind for kind in KINDS if kind != "large"])
+            paths.append(path)
+            result.append(("startup-%d" % size, bench_startup(path)))
+        count = min(size, 1000)
+        for name, bench in [("setitem", bench_setitem), ("update", bench_update)]:
+            path = make_envdir(0)
+            paths.append(path)
+            result.append(("%s-%d" % (name, count), bench(path, count)))
+    return result
+
+
+def run_simple(benchmarks, repeat=5):
+    print("%-18s %12s %12s" % ("benchmark", "best", "mean"))
+    for name, func in benchmarks:
+        # calibrate the number of loops to take at least 0.1 seconds
+        loops = 1
+        while func(loops) < 0.1 and loops < 1000:
+            loops *= 10
+        timings = [func(loops) / loops for _ in range(repeat)]
+        print(
+            "%-18s %9.3f ms %9.3f ms"
+            % (name, min(timings) * 1000, sum(timings) / len(timings) * 1000)
+        )
+
+
+def main():
+    sizes = SIZES
+    if "--quick" in sys.argv:
+        sys.argv.remove("--quick")
+        sizes = QUICK_SIZES
+    saved = os.environ.copy()
+    paths = []
+    try:
+        try:
+            import pyperf
+        except ImportError:
+            run_simple(benchmarks(sizes, paths))
+        else:
+            runner = pyperf.Runner()
+            for name, func in benchmarks(sizes, paths):
+                runner.bench_time_func(name, func)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        for path in paths:
+            remove_envdir(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,29 @@
+import sys
+
 from .runner import runner, go
-from .env import Env  # noqa
 from .version import __version__  # noqa
 
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        # envdir.env is only imported when actually needed
+        if name in ("env", "Env", "Overlay", "ReadOnlyEnv"):
+            # not "from . import env", which would look up envdir.env here
+            from importlib import import_module
+
+            env = import_module(".env", __name__)
+            return env if name == "env" else getattr(env, name)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    def __dir__():
+        return sorted(set(globals()).union(["env", "Env", "Overlay", "ReadOnlyEnv"]))
+
+else:  # pragma: no cover
+    from .env import Env, Overlay, ReadOnlyEnv  # noqa
+
 open = runner.open
+aopen = runner.aopen
+read_only = runner.read_only
 
 
 # for backward compatibility
@@ -10,6 +31,12 @@ def read(path=None):
     return open(path, stacklevel=2)
 
 
+def scan(paths, workers=1):
+    from .bulk import scan
+
+    return scan(paths, workers)
+
+
 def run(*args):
     go(runner.run, *args)
 
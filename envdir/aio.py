@@ -0,0 +1,72 @@
+"""
+Loading envdirs from asyncio code without blocking the event loop, see
+:func:`envdir.aopen` and :meth:`envdir.Env.areload` (Python 3.5+).
+"""
+
+import asyncio
+import functools
+
+from .env import Env, _reread
+
+# the number of files read at the same time by default
+LIMIT = 16
+
+
+async def _read_files(files, limit):
+    """
+    Reads the files of the given (name, path) pairs in the default
+    executor of the loop, no more than limit at a time, and returns the
+    results of _reread in the same order.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(limit)
+
+    async def read(path):
+        async with semaphore:
+            return await loop.run_in_executor(None, _reread, path)
+
+    return await asyncio.gather(*[read(path) for _, path in files])
+
+
+async def aopen(paths, limit=LIMIT, lazy=False, watch=False, **options):
+    """
+    Lists the envdir (or layered envdirs) at paths in the default executor
+    of the loop, reads its files concurrently, no more than limit at a
+    time, and applies them to os.environ from the loop's thread. Returns
+    the same :class:`~envdir.Env` as opening it synchronously.
+    """
+    loop = asyncio.get_event_loop()
+    # listing only, which doesn't apply anything, unless loading the cache
+    env = await loop.run_in_executor(
+        None, functools.partial(Env, paths, lazy=True, **options)
+    )
+    if not lazy:
+        if env._pack is not None:
+            # a single mapping of the pack, nothing to read concurrently
+            env.apply()
+        else:
+            files = [(name, env._path(name)) for name in env._pending]
+            for (name, _), result in zip(files, await _read_files(files, limit)):
+                env._reloaded(name, result)
+        env.lazy = False
+    if watch:
+        env.watch(None if watch is True else watch)
+    return env
+
+
+async def refresh(env, limit=LIMIT):
+    """
+    Like :meth:`envdir.Env.refresh`, listing the envdir and reading the
+    changed files in the default executor of the loop.
+    """
+    if env._pack is not None:
+        # a single mapping of the pack, nothing to read concurrently
+        return env.refresh()
+    loop = asyncio.get_event_loop()
+    files = await loop.run_in_executor(None, env._changed_files)
+    changes = []
+    for (name, _), result in zip(files, await _read_files(files, limit)):
+        old, new = env._reloaded(name, result)
+        if old != new:
+            changes.append((name, old, new))
+    return changes
@@ -0,0 +1,77 @@
+"""
+Reading many envdirs at once, see :func:`envdir.scan`.
+"""
+
+import time
+
+from .env import ReadOnlyEnv
+
+try:
+    perf_counter = time.perf_counter
+except AttributeError:  # <python3.3
+    perf_counter = time.time
+
+
+class ScanResult(object):
+    """
+    The outcome of reading one envdir: its variables as a
+    :class:`~envdir.ReadOnlyEnv` (None if reading it failed), the error
+    reading it raised (an EnvironmentError or a ValueError, e.g. a
+    UnicodeDecodeError) and the seconds it took.
+    """
+
+    __slots__ = ("path", "env", "error", "seconds")
+
+    def __init__(self, path, env, error, seconds):
+        self.path = path
+        self.env = env
+        self.error = error
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "<envdir.ScanResult %r %s in %.1f ms>" % (
+            self.path,
+            "failed" if self.error else "%d variables" % len(self.env),
+            self.seconds * 1000,
+        )
+
+
+def read(path):
+    start = perf_counter()
+    try:
+        env = ReadOnlyEnv(path)
+    except (EnvironmentError, ValueError) as err:
+        # e.g. undecodable values or a file which isn't a pack
+        return ScanResult(path, None, err, perf_counter() - start)
+    return ScanResult(path, env, None, perf_counter() - start)
+
+
+def scan(paths, workers=1):
+    """
+    Reads the envdirs at the given paths (or lists of paths of layered
+    envdirs) with the given number of threads, without changing
+    os.environ, and yields a :class:`ScanResult` for each of them as soon
+    as it is read. No more than twice as many envdirs as there are
+    workers are read ahead, so paths can be a generator of any length.
+    """
+    if workers > 1:
+        try:
+            from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        except ImportError:  # <python3.2
+            workers = 1
+    if workers <= 1:
+        for path in paths:
+            yield read(path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for path in paths:
+            pending.add(pool.submit(read, path))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
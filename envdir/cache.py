@@ -0,0 +1,231 @@
+"""
+Persistent snapshots of envdirs.
+
+A snapshot stores the values :class:`envdir.Env` loaded from an envdir
+together with the modification time of the directory and the inode,
+modification time and size of every file in it. As long as none of those
+changed, the values can be taken from the snapshot instead of opening and
+reading every single file of the envdir again.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from .env import _encoding, _fsdecode, _fsencode, _mtime_ns, _scan, fingerprint
+
+try:
+    replace = os.replace
+except AttributeError:  # <python3.3
+    replace = os.rename
+
+MAGIC = b"ENVDIRC\x01"
+
+# magic, directory mtime, number of entries, length of path and encoding
+_header = struct.Struct("<8sqIII")
+# inode, mtime, size, length of name and value (-1 for empty files)
+_entry = struct.Struct("<QqqIi")
+
+# files modified less than this many seconds before a snapshot is taken
+# could be modified again without changing their mtime, so such snapshots
+# are never written to disk
+RACY_SECONDS = 2.0
+
+
+def cache_dir():
+    """
+    The directory snapshots are stored in by default, ``envdir`` below
+    ``$XDG_CACHE_HOME`` (or ``~/.cache``).
+    """
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(root, "envdir")
+
+
+def cache_path(path):
+    """
+    The default snapshot file of the envdir at path.
+    """
+    path = os.path.abspath(path)
+    if not isinstance(path, bytes):
+        path = path.encode("utf-8", "surrogateescape")
+    digest = hashlib.sha1(path)
+    return os.path.join(cache_dir(), digest.hexdigest() + ".cache")
+
+
+class Snapshot(object):
+    """
+    The loaded values of an envdir and the fingerprints of its files.
+    """
+
+    def __init__(self, path, mtime_ns, encoding, entries):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.encoding = encoding
+        # list of (name, fingerprint, value) tuples
+        self.entries = entries
+
+    @classmethod
+    def build(cls, path, workers=1):
+        mtime_ns = _mtime_ns(os.stat(path))
+        entries = [
+            (name, fingerprint(stat), value)
+            for name, stat, value in _scan(path, workers)
+        ]
+        return cls(path, mtime_ns, _encoding(), entries)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Reads a snapshot from the given file, returns None if it doesn't
+        exist or isn't a valid snapshot.
+        """
+        try:
+            with open(filename, "rb") as cache:
+                buf = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            return cls._parse(buf)
+        except (struct.error, ValueError, UnicodeDecodeError):
+            return None
+        finally:
+            buf.close()
+
+    @classmethod
+    def _parse(cls, buf):
+        magic, mtime_ns, count, path_len, encoding_len = _header.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("not an envdir snapshot")
+        offset = _header.size
+        end = offset + path_len
+        path = _fsdecode(buf[offset:end])
+        offset, end = end, end + encoding_len
+        # empty for the native byte strings of Python 2
+        encoding = buf[offset:end].decode("ascii") or None
+        offset = end
+        entries = []
+        for _ in range(count):
+            ino, entry_mtime_ns, size, name_len, value_len = _entry.unpack_from(
+                buf, offset
+            )
+            offset += _entry.size
+            end = offset + name_len
+            name = _fsdecode(buf[offset:end])
+            offset = end
+            if value_len < 0:
+                value = None
+            else:
+                end = offset + value_len
+                value = buf[offset:end]
+                if encoding is not None:
+                    value = value.decode("utf-8", "surrogatepass")
+                offset = end
+            entries.append((name, (ino, entry_mtime_ns, size), value))
+        if offset != len(buf):
+            raise ValueError("trailing data in envdir snapshot")
+        return cls(path, mtime_ns, encoding, entries)
+
+    def dump(self):
+        path = _fsencode(self.path)
+        encoding = (self.encoding or "").encode("ascii")
+        chunks = [
+            _header.pack(
+                MAGIC, self.mtime_ns, len(self.entries), len(path), len(encoding)
+            ),
+            path,
+            encoding,
+        ]
+        for name, (ino, mtime_ns, size), value in self.entries:
+            name = _fsencode(name)
+            if value is None:
+                chunks.append(_entry.pack(ino, mtime_ns, size, len(name), -1))
+                chunks.append(name)
+            else:
+                if not isinstance(value, bytes):
+                    value = value.encode("utf-8", "surrogatepass")
+                chunks.append(_entry.pack(ino, mtime_ns, size, len(name), len(value)))
+                chunks.append(name)
+                chunks.append(value)
+        return b"".join(chunks)
+
+    def write(self, filename):
+        """
+        Atomically replaces the given file with this snapshot, so that
+        concurrent readers either see the old or the new snapshot.
+        """
+        directory = os.path.dirname(filename)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as cache:
+                cache.write(self.dump())
+            replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def is_racy(self, now=None):
+        """
+        Whether any file was modified too shortly before the snapshot was
+        taken for a later modification to be detectable by its mtime.
+        """
+        if now is None:
+            now = time.time()
+        limit = int((now - RACY_SECONDS) * 1e9)
+        return self.mtime_ns >= limit or any(
+            mtime_ns >= limit for _, (_, mtime_ns, _), _ in self.entries
+        )
+
+    def is_fresh(self, path):
+        """
+        Whether the envdir at path is still in the state this snapshot was
+        taken of: one stat of the directory plus one stat per file.
+        """
+        if os.path.abspath(path) != os.path.abspath(self.path):
+            return False
+        if self.encoding != _encoding():
+            return False
+        try:
+            if _mtime_ns(os.stat(path)) != self.mtime_ns:
+                return False
+            for name, entry_fingerprint, _ in self.entries:
+                if fingerprint(os.stat(os.path.join(path, name))) != entry_fingerprint:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def values(self):
+        return [(name, value) for name, _, value in self.entries]
+
+
+def load(path, cache=True, rebuild=False, workers=1):
+    """
+    Returns the (name, fingerprint, value) entries of the envdir at path,
+    taken from its snapshot if that is still fresh. Otherwise the envdir is read and the
+    snapshot is replaced. ``cache`` is either the snapshot file to use or
+    ``True`` for the default location, see :func:`cache_path`. ``workers``
+    is the number of threads reading the envdir, if necessary.
+    """
+    filename = cache_path(path) if cache is True else cache
+    if not rebuild:
+        snapshot = Snapshot.read(filename)
+        if snapshot is not None and snapshot.is_fresh(path):
+            return snapshot.entries
+    snapshot = Snapshot.build(path, workers)
+    if not snapshot.is_racy():
+        try:
+            snapshot.write(filename)
+        except (IOError, OSError):
+            # the cache is an optimization only, e.g. for read-only homes
+            pass
+    return snapshot.entries
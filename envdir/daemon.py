@@ -0,0 +1,200 @@
+"""
+A daemon keeping the values of envdirs in memory, see ``envdir serve``
+and ``envdir --via-daemon``.
+
+Clients send the absolute paths of the (layered) envdirs to load, each
+terminated by a NUL character, and shut down their side of the
+connection. The daemon answers with a status line, ``0`` or an error
+message, followed by the variables as NUL terminated ``NAME=value``
+entries, or just ``NAME`` for variables unset by empty files.
+"""
+
+import os
+import socket
+import stat
+import threading
+
+from .cache import Snapshot
+from .env import _fsdecode, _fsencode
+
+
+def socket_path():
+    """
+    The Unix socket of the daemon, ``$ENVDIR_SOCKET`` or ``envdir-UID.sock``
+    in ``$XDG_RUNTIME_DIR`` (or the temporary directory).
+    """
+    path = os.environ.get("ENVDIR_SOCKET")
+    if path:
+        return path
+    root = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+    return os.path.join(root, "envdir-%d.sock" % os.getuid())
+
+
+def is_owned(path):
+    """
+    Whether there is a Unix socket at path which is owned by the current
+    user, so that it can't have been put there by another user, e.g. in a
+    shared temporary directory.
+    """
+    try:
+        result = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(result.st_mode) and result.st_uid == os.getuid()
+
+
+def _encode(text):
+    if isinstance(text, bytes):  # the native strings of Python 2
+        return text
+    return text.encode("utf-8", "surrogatepass")
+
+
+def _decode(data):
+    if bytes is str:  # <python3, keeping native strings
+        return data
+    return data.decode("utf-8", "surrogatepass")
+
+
+def fetch(paths, path=None, timeout=5.0):
+    """
+    Asks the daemon listening at path for the (name, value) pairs of the
+    envdirs at the given paths, with None values for unset variables.
+    Returns None if there is no daemon, it fails to answer or its socket
+    isn't owned by the current user.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    path = path or socket_path()
+    if not is_owned(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(b"".join(_fsencode(layer) + b"\0" for layer in paths))
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (socket.error, OSError):
+        return None
+    finally:
+        client.close()
+    status, _, body = b"".join(chunks).partition(b"\n")
+    if status != b"0":
+        return None
+    values = []
+    for entry in body.split(b"\0")[:-1]:
+        name, equals, value = _decode(entry).partition("=")
+        values.append((name, value if equals else None))
+    return values
+
+
+class Server(object):
+    """
+    Answers the requests of clients, reusing the values of every envdir
+    read before as long as its snapshot is fresh, see
+    :meth:`envdir.cache.Snapshot.is_fresh`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+        # the snapshots of the envdirs, mapped to their paths
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.socket = None
+
+    def bind(self):
+        if os.path.lexists(self.path):
+            if not is_owned(self.path):
+                raise OSError("%s is not a socket owned by this user" % self.path)
+            if fetch([], self.path, timeout=1.0) is not None:
+                raise OSError("envdir daemon already listening at %s" % self.path)
+            # left behind by a daemon which didn't exit cleanly
+            os.remove(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.socket.listen(64)
+
+    def snapshot(self, path):
+        with self.lock:
+            snapshot = self.snapshots.get(path)
+        if snapshot is not None and snapshot.is_fresh(path):
+            return snapshot
+        snapshot = Snapshot.build(path)
+        with self.lock:
+            if snapshot.is_racy():
+                # could change again without being detected
+                self.snapshots.pop(path, None)
+            else:
+                self.snapshots[path] = snapshot
+        return snapshot
+
+    def values(self, paths):
+        merged = {}
+        for path in paths:
+            for name, _, value in self.snapshot(path).entries:
+                merged[name] = value
+        return merged
+
+    def respond(self, request):
+        paths = [_fsdecode(path) for path in request.split(b"\0")[:-1]]
+        try:
+            values = self.values(paths)
+        except (IOError, OSError, ValueError) as err:
+            return ("%s\n" % err).encode("utf-8", "replace")
+        chunks = [b"0\n"]
+        for name, value in values.items():
+            if value is None:
+                chunks.append(_encode(name) + b"\0")
+            else:
+                chunks.append(_encode("%s=%s" % (name, value)) + b"\0")
+        return b"".join(chunks)
+
+    def handle(self, connection):
+        try:
+            chunks = []
+            while True:
+                chunk = connection.recv(64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            connection.sendall(self.respond(b"".join(chunks)))
+        except (socket.error, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def serve(self):
+        """
+        Accepts connections until stop() is called, handling each one in
+        a thread of its own.
+        """
+        if self.socket is None:
+            self.bind()
+        self.socket.settimeout(0.5)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    connection, _ = self.socket.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                thread = threading.Thread(target=self.handle, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.socket.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def stop(self):
+        self.stopped.set()
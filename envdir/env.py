@@ -1,10 +1,41 @@
+import codecs
+import errno
 import os
+import sys
+from bisect import bisect_left
 
 try:
     from UserDict import IterableUserDict as UserDict
 except ImportError:
     from collections import UserDict
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # <python3.3
+    from collections import Mapping
+
+try:
+    from os import scandir
+except ImportError:  # <python3.5
+    scandir = None
+
+try:
+    from os import replace
+except ImportError:  # <python3.3
+    from os import rename as replace
+
+try:
+    from os import fsdecode as _fsdecode, fsencode as _fsencode
+except ImportError:  # <python3.2, where native paths are bytes already
+
+    def _fsencode(path):
+        if isinstance(path, bytes):
+            return path
+        return path.encode(sys.getfilesystemencoding())
+
+    def _fsdecode(path):
+        return path
+
 
 def isenvvar(name):
     root, name = os.path.split(name)
@@ -22,22 +53,544 @@ except NameError:  # <python3
 
 _sentinel = object()
 
+_open_flags = os.O_RDONLY | getattr(os, "O_BINARY", 0) | getattr(os, "O_CLOEXEC", 0)
+
+# files at least this large are mapped into memory instead of being read
+# into a buffer, see _read() and _decode()
+MMAP_THRESHOLD = 64 * 1024
+
+
+class _Entry(object):
+    """
+    Minimal stand-in for os.DirEntry on Pythons without os.scandir.
+    """
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scandir(path):
+    if scandir is None:
+        return [_Entry(path, name) for name in os.listdir(path)]
+    return scandir(path)
+
+
+def _read(path):
+    """
+    Reads the raw content of the file at path with a single open, fstat
+    and (usually) a single read into a buffer sized by the fstat result.
+    Returns the stat result of the file and its content, which is an mmap
+    for files of at least MMAP_THRESHOLD bytes, closed by _decode().
+    """
+    fd = os.open(path, _open_flags)
+    try:
+        stat = os.fstat(fd)
+        size = stat.st_size
+        if size == 0:
+            return stat, b""
+        if size >= MMAP_THRESHOLD:
+            import mmap
+
+            try:
+                return stat, mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # e.g. filesystems not supporting it, read it instead
+                pass
+        data = os.read(fd, size)
+        if len(data) < size:
+            # short read, e.g. on some network filesystems
+            chunks = [data]
+            remaining = size - len(data)
+            while remaining > 0:
+                chunk = os.read(fd, remaining)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            data = b"".join(chunks)
+        return stat, data
+    finally:
+        os.close(fd)
+
+
+def _reread(path):
+    """
+    Like _read, but returns None if there is no file at path (anymore),
+    e.g. if the variable was removed.
+    """
+    try:
+        if path is None:
+            raise OSError(errno.ENOENT, "No such file or directory")
+        return _read(path)
+    except EnvironmentError as err:
+        if err.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+            raise
+        return None
+
+
+def _mtime_ns(stat):
+    try:
+        return stat.st_mtime_ns
+    except AttributeError:  # <python3.3
+        return int(stat.st_mtime * 1e9)
+
+
+def fingerprint(stat):
+    """
+    The (inode, mtime in nanoseconds, size) triple of a stat result.
+    """
+    return stat.st_ino, _mtime_ns(stat), stat.st_size
+
+
+def _encoding():
+    """
+    The encoding open() uses for text files, without importing the locale
+    module (and thereby re) on recent Pythons. None on Python 2, where
+    text files are read as native (byte) strings, see _decode().
+    """
+    if bytes is str:  # <python3
+        return None
+    if getattr(sys.flags, "utf8_mode", False):
+        return "utf-8"
+    try:
+        from _locale import getencoding  # python3.11+
+    except ImportError:
+        import locale
+
+        return locale.getpreferredencoding(False)
+    return getencoding()
+
+
+def _ascii_compatible(encoding, cache={}):
+    """
+    Whether newlines, carriage returns and NUL characters are encoded as
+    single bytes of the same value in the given encoding.
+    """
+    if encoding not in cache:
+        try:
+            cache[encoding] = "\n\r\x00".encode(encoding) == b"\n\r\x00"
+        except (LookupError, UnicodeError):
+            cache[encoding] = False
+    return cache[encoding]
+
+
+def _decode_mapped(buf, encoding):
+    """
+    Like _decode() for the memory mapped content of a file, without
+    copying it before decoding: the bounds of the value without the
+    leading and trailing newlines are looked up in the mapping, only that
+    part of it is decoded and NULs are only replaced if there are any.
+    """
+    if buf.find(b"\r") != -1 or not _ascii_compatible(encoding):
+        return _decode(buf[:], encoding)
+    # an int on python3, like the items of buf
+    newline = b"\n"[0]
+    start, end = 0, len(buf)
+    while start < end and buf[start] == newline:
+        start += 1
+    while end > start and buf[end - 1] == newline:
+        end -= 1
+    view = memoryview(buf)
+    part = view[start:end]
+    try:
+        value = codecs.decode(part, encoding)
+    finally:
+        part.release()
+        view.release()
+    if buf.find(b"\x00", start, end) != -1:
+        value = value.replace("\x00", "\n")
+    return value
+
+
+def _decode(data, encoding):
+    """
+    Turns the raw content of an envdir file into the variable value, the
+    same way reading it in text mode and applying envdir's rules would.
+    Without an encoding (in binary mode), the value is returned as bytes,
+    as is but for the same rules.
+    """
+    if not isinstance(data, bytes):
+        try:
+            if encoding is None:
+                return _decode(data[:], None)
+            return _decode_mapped(data, encoding)
+        finally:
+            data.close()
+    if encoding is None:
+        return data.strip(b"\n").replace(b"\x00", b"\n")
+    value = data.decode(encoding)
+    if "\r" in value:
+        # universal newlines, as done by text mode reads
+        value = value.replace("\r\n", "\n").replace("\r", "\n")
+    return value.strip("\n").replace("\x00", "\n")
+
+
+def _files(path):
+    """
+    Yields the directory entries of the variable files at the top level
+    of the envdir at path.
+    """
+    for entry in _scandir(path):
+        if isenvvar(entry.name) and not entry.is_dir():
+            yield entry
+
+
+def _read_many(paths, workers=1):
+    """
+    Yields the results of _read() for the given paths, in order. With more
+    than one worker the files are read by a pool of threads, overlapping
+    the latency of e.g. network filesystems.
+    """
+    if workers > 1:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:  # <python3.2
+            workers = 1
+    if workers <= 1:
+        for path in paths:
+            yield _read(path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_read, paths):
+            yield result
+
+
+def _read_entries(entries, workers=1, binary=False):
+    """
+    Yields the name, stat result and value of the given directory entries
+    of variable files. The value is None for empty files, which remove the
+    variable from the environment, and bytes in binary mode.
+    """
+    encoding = None if binary else _encoding()
+    if workers > 1:
+        entries = list(entries)
+        results = _read_many([entry.path for entry in entries], workers)
+        for entry, (stat, data) in zip(entries, results):
+            yield entry.name, stat, _decode(data, encoding) if data else None
+        return
+    for entry in entries:
+        stat, data = _read(entry.path)
+        yield entry.name, stat, _decode(data, encoding) if data else None
+
+
+def _scan(path, workers=1):
+    """
+    Yields the name, stat result and value of every variable file at the
+    top level of the envdir at path, see _read_entries().
+    """
+    return _read_entries(_files(path), workers)
+
+
+def _digest(name, value=_sentinel, stat=None):
+    """
+    The SHA-256 digest, as an integer, of a variable and its value (None
+    if unset), or of the name and the stat result of its file. The digests
+    of an envdir are combined with XOR, which doesn't depend on their order
+    and allows to replace the digest of a single variable.
+    """
+    import hashlib
+
+    if stat is not None:
+        entry = "%s\0%d\0%d\0%d" % ((name,) + fingerprint(stat))
+    elif value is _sentinel:
+        return 0
+    elif value is None:
+        entry = name + "\0"
+    elif isinstance(value, bytes):
+        # binary mode, the same digest as for the value decoded as UTF-8
+        entry = "%s=" % name
+    else:
+        entry = "%s=%s" % (name, value)
+    data = entry.encode("utf-8", "surrogatepass")
+    if isinstance(value, bytes):
+        data += value
+    return int(hashlib.sha256(data).hexdigest(), 16)
+
+
+def digest(paths, fast=False, workers=1):
+    """
+    The fingerprint of the (layered) envdirs at paths as a hex string,
+    computed from the names and values of their variables or, if fast, from
+    the names, inodes, modification times and sizes of their files without
+    reading them. See :meth:`Env.fingerprint`.
+    """
+    result = 0
+    if fast and not _is_pack(paths):
+        for name, entry in _merge(paths).items():
+            result ^= _digest(name, stat=entry.stat())
+    else:
+        for name, _, value in _scan_layers(paths, workers):
+            result ^= _digest(name, value)
+    return "%064x" % result
+
+
+_booleans = {
+    "1": True,
+    "true": True,
+    "yes": True,
+    "on": True,
+    "0": False,
+    "false": False,
+    "no": False,
+    "off": False,
+    "": False,
+}
+
+
+def _parse_bool(value):
+    try:
+        return _booleans[value.strip().lower()]
+    except KeyError:
+        raise ValueError("not a boolean: %r" % value)
+
+
+def _parse_list(sep):
+    def parse(value):
+        return tuple(item.strip() for item in value.split(sep)) if value else ()
+
+    return parse
+
+
+def _parse_json(value):
+    import json
+
+    return json.loads(value)
+
+
+def _parse_url(value):
+    try:
+        from urllib.parse import urlsplit
+    except ImportError:  # <python3
+        from urlparse import urlsplit
+
+    return urlsplit(value)
+
+
+def _merge(paths):
+    """
+    Returns the directory entries of the variable files of the envdirs at
+    the given paths, mapped to their names. Files in later envdirs take
+    precedence over the ones with the same name in earlier envdirs.
+    """
+    merged = {}
+    for path in paths:
+        for entry in _files(path):
+            merged[entry.name] = entry
+    return merged
+
+
+def _is_pack(paths):
+    """
+    Whether paths is the path of a pack file instead of envdirs, see
+    :mod:`envdir.pack`.
+    """
+    return len(paths) == 1 and os.path.isfile(paths[0])
+
+
+def _scan_layers(paths, workers=1):
+    """
+    Like _scan(), for the merged variable files of layered envdirs (or the
+    variables of a pack).
+    """
+    if _is_pack(paths):
+        from .pack import scan
+
+        return scan(paths[0])
+    if len(paths) == 1:
+        return _scan(paths[0], workers)
+    return _read_entries(_merge(paths).values(), workers)
+
+
+def _fsync_dir(path):
+    if os.name == "nt":
+        # directories can't be opened (and don't need to be synced)
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Transaction(object):
+    """
+    Stages the writes and deletions done to an Env and publishes them
+    together on exit, see :meth:`Env.transaction`.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.outermost = False
+
+    def __enter__(self):
+        if self.env._staged is None:
+            self.env._staged = {}
+            self.outermost = True
+        return self.env
+
+    def __exit__(self, type, value, traceback):
+        if not self.outermost:
+            return
+        staged, self.env._staged = self.env._staged, None
+        if type is None:
+            self.env._commit(staged)
+
+
+# the overlays currently applied to os.environ, see Overlay
+_overlays = []
+
+
+class Overlay(object):
+    """
+    Variables (None to unset them) to apply to os.environ on top of the
+    overlays applied before, e.g. for a test, which records only the
+    values it actually changes. Popping an overlay restores them, after
+    popping the overlays pushed after it, in reverse order. Can be used
+    as context manager, too.
+    """
+
+    __slots__ = ("values", "saved")
+
+    def __init__(self, values=None, **kwargs):
+        self.values = dict(values or (), **kwargs)
+        # the values replaced when pushed, None if not pushed
+        self.saved = None
+
+    def __repr__(self):
+        return "<envdir.Overlay of %d variables%s>" % (
+            len(self.values),
+            "" if self.saved is None else ", %d changed" % len(self.saved),
+        )
+
+    def __enter__(self):
+        return self.push()
+
+    def __exit__(self, type, value, traceback):
+        if self.saved is not None:
+            self.pop()
+
+    def push(self):
+        if self.saved is not None:
+            raise ValueError("overlay is already pushed")
+        saved = {}
+        for name, value in self.values.items():
+            old = os.environ.get(name)
+            if old == value:
+                continue
+            saved[name] = old
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+        self.saved = saved
+        _overlays.append(self)
+        return self
+
+    def pop(self):
+        if self.saved is None:
+            raise ValueError("overlay is not pushed")
+        while True:
+            overlay = _overlays.pop()
+            for name, old in overlay.saved.items():
+                if old is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = old
+            overlay.saved = None
+            if overlay is self:
+                return
+
 
 class Env(UserDict):
     """
     An dict-like object to represent an envdir environment with extensive
     API, can be used as context manager, too.
+
+    Pass a list of paths to layer multiple envdirs, later envdirs take
+    precedence over earlier ones and values are written to the last one.
+    With ``apply=False`` the variables are not applied to os.environ.
+    With ``binary=True`` the values are bytes, read without decoding them
+    and applied to os.environb.
     """
 
-    def __init__(self, path):
-        self.path = path
+    def __init__(
+        self,
+        path,
+        cache=False,
+        rebuild_cache=False,
+        lazy=False,
+        watch=False,
+        workers=1,
+        apply=True,
+        trace=False,
+        binary=False,
+    ):
+        if isinstance(path, (list, tuple)):
+            if not path:
+                raise ValueError("at least one envdir path is required")
+            self.paths = list(path)
+        else:
+            self.paths = [path]
+        self.path = self.paths[-1]
+        self.cache = cache
+        self.rebuild_cache = rebuild_cache
+        self.lazy = lazy
+        self.workers = workers
+        # whether the variables are applied to os.environ
+        self._apply = apply
+        self.binary = binary
+        if not binary:
+            self._environ, self._key = os.environ, str
+        elif bytes is str:  # <python3, os.environ holds bytes
+            self._environ, self._key = os.environ, str
+        elif hasattr(os, "environb"):
+            self._environ, self._key = os.environb, os.fsencode
+        else:
+            raise ValueError("binary mode requires os.environb")
+        if binary and cache:
+            raise ValueError("the snapshot cache doesn't support binary mode")
         self.data = {}
         self.originals = {}
         self.created = {}
+        # names of the files not read yet in lazy mode, mapped to
+        # whether they are non-empty
+        self._pending = {}
+        # writes (and deletions as None) of the current transaction
+        self._staged = None
+        # fingerprints of the files as last read, see fingerprint()
+        self._stats = {}
+        # paths of the files of layered envdirs, mapped to their names
+        self._index = {}
+        # the environment of child processes, see as_exec_env()
+        self._exec_env = None
+        # names of the variables unset by empty files
+        self._unset = set()
+        # the combined digests of the variables, see fingerprint()
+        self._digest = None
+        # the parsed values of the variables by parser, see get_int() etc.
+        self._parsed = {}
+        # the memory mapped pack if path is a pack file, see envdir.pack
+        self._pack = None
+        self._watcher = None
+        if trace is True:
+            from .trace import Tracer
+
+            trace = Tracer()
+        # records the timings of loading the envdir, see stats
+        self._tracer = trace or None
         self._load()
+        if watch:
+            self.watch(None if watch is True else watch)
 
     def __repr__(self):
-        return "<envdir.Env '%s'>" % self.path
+        return "<envdir.Env '%s'>" % os.pathsep.join(self.paths)
 
     def __enter__(self):
         return self
@@ -46,6 +599,14 @@ class Env(UserDict):
         self.clear()
 
     def __getitem__(self, name, default=_sentinel):
+        if self.lazy:
+            if name in self._pending:
+                self._resolve(name)
+            if name in self.data:
+                return self.data[name]
+            if default is _sentinel:
+                raise KeyError(name)
+            return default
         try:
             return self._get(name, default=default)
         except (_EmptyFile, FileNotFoundError):
@@ -54,58 +615,613 @@ class Env(UserDict):
             return default
 
     def __setitem__(self, name, value):
+        self._pending.pop(name, None)
+        if self._staged is not None:
+            self._staged[name] = value
+            return
         self._write(**{name: value})
+        self._index.pop(name, None)
         self._set(name, value)
         self.created[name] = value
 
     def __delitem__(self, name):
+        self._pending.pop(name, None)
+        if self._staged is not None:
+            self._staged[name] = None
+            return
         os.remove(os.path.join(self.path, name))
-        self._delete(name)
+        self._index.pop(name, None)
+        if len(self.paths) > 1:
+            # an earlier envdir may still set it
+            self._reload(name)
+        else:
+            self._delete(name)
 
     def __contains__(self, name):
-        return name in self.data or os.path.exists(os.path.join(self.path, name))
+        if self.lazy:
+            return name in self.data or self._pending.get(name, False)
+        return name in self.data or self._locate(name) is not None
+
+    def __iter__(self):
+        for name in list(self.data):
+            yield name
+        for name, nonempty in list(self._pending.items()):
+            if nonempty:
+                yield name
+
+    def __len__(self):
+        return len(self.data) + sum(self._pending.values())
+
+    def _listing(self):
+        """
+        The merged directory entries of the variable files, see _merge().
+        """
+        if len(self.paths) == 1:
+            return dict((entry.name, entry) for entry in _files(self.path))
+        listing = _merge(self.paths)
+        self._index = dict((name, entry.path) for name, entry in listing.items())
+        return listing
+
+    def _path(self, name):
+        return self._index.get(name) or os.path.join(self.path, name)
+
+    def _locate(self, name):
+        """
+        Looks up the path of the file of a variable on disk, returns None
+        if there is none.
+        """
+        for layer in reversed(self.paths):
+            path = os.path.join(layer, name)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                if len(self.paths) > 1:
+                    self._index[name] = path
+                return path
+        self._index.pop(name, None)
+        return None
+
+    @property
+    def stats(self):
+        """
+        The timings and system call counts of loading the envdir as a
+        dict, if it was created with ``trace=True`` (None otherwise).
+        """
+        if self._tracer is None:
+            return None
+        return self._tracer.stats()
 
     def _load(self):
-        for _, _, files in os.walk(self.path, followlinks=True):
-            for path in filter(isenvvar, files):
-                root, name = os.path.split(path)
-                try:
-                    value = self._get(name)
-                except _EmptyFile:
-                    self._delete(name)
-                else:
-                    self._set(name, value)
+        if len(self.paths) == 1:
+            try:
+                return self._load_traced()
+            except EnvironmentError as err:
+                # e.g. a symlinked variable pointing below a regular file
+                # fails with ENOTDIR as well, only listing a file fails
+                # before anything was loaded
+                if err.errno != errno.ENOTDIR or not os.path.isfile(self.path):
+                    raise
+            # not a directory, without stat'ing every envdir to find out
+            from .pack import Pack
+
+            self._pack = Pack(self.path)
+            # a snapshot already
+            self.cache = self.rebuild_cache = False
+        self._load_traced()
+
+    def _load_traced(self):
+        if self._tracer is not None:
+            return self._tracer.load(self, self._load_values)
+        self._load_values()
+
+    def _load_values(self):
+        if self.lazy and not self.cache:
+            # only list the names, their sizes tell apart empty files
+            if self._pack is not None:
+                for name, size in self._pack.sizes():
+                    self._pending[name] = size > 0
+                return
+            for name, entry in self._listing().items():
+                self._pending[name] = entry.stat().st_size > 0
+            return
+        if self.cache:
+            values = self._load_cached()
+        else:
+            values = self._scan()
+        for name, value in values:
+            if value is None:
+                self._empty(name)
+            else:
+                self._set(name, value)
+
+    def _load_cached(self):
+        from .cache import load
+
+        if len(self.paths) > 1 and self.cache is not True:
+            raise ValueError("layered envdirs can only use the default cache")
+        merged = {}
+        for layer in self.paths:
+            entries = load(
+                layer, self.cache, rebuild=self.rebuild_cache, workers=self.workers
+            )
+            for name, stat, value in entries:
+                merged[name] = (layer, stat, value)
+        values = []
+        for name, (layer, stat, value) in merged.items():
+            if len(self.paths) > 1:
+                self._index[name] = os.path.join(layer, name)
+            self._stats[name] = stat
+            values.append((name, value))
+        return values
+
+    def _scan(self):
+        if self._pack is not None:
+            encoding = self._encoding()
+            for name, data in self._pack.items():
+                self._stats[name] = self._pack.fingerprint
+                yield name, _decode(data, encoding) if data else None
+            return
+        if len(self.paths) == 1:
+            entries = _files(self.path)
+        else:
+            entries = self._listing().values()
+        if self._tracer is None:
+            results = _read_entries(entries, self.workers, self.binary)
+        else:
+            results = self._tracer.read_entries(entries, self.workers, self.binary)
+        for name, stat, value in results:
+            self._stats[name] = fingerprint(stat)
+            yield name, value
+
+    def _reload(self, name, path=_sentinel):
+        """
+        Rereads a single variable from its file (at the given path, or
+        looked up on disk) and applies the result, returns the old and the
+        new value (None if unset).
+        """
+        if path is _sentinel:
+            path = self._locate(name)
+        return self._reloaded(name, _reread(path))
+
+    def _reloaded(self, name, result):
+        """
+        Applies the result of rereading the file of a variable, see
+        :func:`_reread`, returns the old and the new value (None if unset).
+        """
+        self._pending.pop(name, None)
+        old = self.data.get(name)
+        if result is None:
+            self._stats.pop(name, None)
+            data = new = None
+        else:
+            stat, data = result
+            self._stats[name] = fingerprint(stat)
+            new = _decode(data, self._encoding()) if data else None
+        if data is not None and new is None:
+            self._empty(name)
+        elif new is None:
+            self._delete(name)
+        elif new != old:
+            self._set(name, new)
+        return old, new
+
+    def refresh(self):
+        """
+        Rereads only the files which were added, modified or removed since
+        they were read last, as told by their inode, modification time and
+        size, and applies the changes to os.environ. Returns a list of
+        (name, old value, new value) tuples of the changed variables, with
+        None standing for unset variables.
+        """
+        if self._pack is not None:
+            results = self._changed_pack()
+        else:
+            results = ((name, _reread(path)) for name, path in self._changed_files())
+        changes = []
+        for name, result in results:
+            old, new = self._reloaded(name, result)
+            if old != new:
+                changes.append((name, old, new))
+        return changes
+
+    def _changed_pack(self):
+        """
+        Maps the pack again if it was replaced and returns the names and
+        results (see _reread) of all variables, for :meth:`refresh`.
+        """
+        if fingerprint(os.stat(self.path)) == self._pack.fingerprint:
+            return []
+        from .pack import Pack
+
+        self._pack.close()
+        self._pack = Pack(self.path)
+        results = [(name, (self._pack.stat, data)) for name, data in self._pack.items()]
+        removed = set(self.data).union(self._unset, self._pending)
+        removed.difference_update(name for name, _ in results)
+        results.extend((name, None) for name in removed)
+        return results
+
+    def areload(self, limit=None):
+        """
+        Like :meth:`refresh`, but a coroutine to be awaited in asyncio code,
+        which lists the envdir and reads the changed files in the default
+        executor of the loop, no more than limit (16 by default) at a time.
+        """
+        from .aio import LIMIT, refresh
+
+        return refresh(self, LIMIT if limit is None else limit)
+
+    def _changed_files(self):
+        """
+        Lists the envdir and returns the names and paths (None if removed)
+        of the variables whose files need to be reread by :meth:`refresh`.
+        """
+        listing = self._listing()
+        current = {}
+        for name, entry in list(listing.items()):
+            try:
+                current[name] = fingerprint(entry.stat())
+            except FileNotFoundError:
+                # removed since the envdir was listed
+                del listing[name]
+        for name in list(self._pending):
+            # not read yet anyway, only whether it's there and not empty
+            if name in current:
+                self._pending[name] = current.pop(name)[2] > 0
+            else:
+                del self._pending[name]
+        names = [name for name in current if self._stats.get(name) != current[name]]
+        names.extend(
+            name for name in set(self._stats).union(self.data) if name not in current
+        )
+        return [
+            (name, listing[name].path if name in listing else None) for name in names
+        ]
+
+    def _resolve(self, name):
+        del self._pending[name]
+        try:
+            value = self._get(name)
+        except _EmptyFile:
+            self._empty(name)
+        except FileNotFoundError:
+            # removed since the envdir was opened
+            pass
+        else:
+            self._set(name, value)
 
     def _open(self, name, mode="r"):
         return open(os.path.join(self.path, name), mode)
 
     def _get(self, name, default=_sentinel):
-        path = os.path.join(self.path, name)
-        if os.stat(path).st_size == 0:
+        if self._pack is not None:
+            try:
+                data = self._pack.get(name)
+            except KeyError:
+                raise FileNotFoundError(errno.ENOENT, "No such variable", name)
+        else:
+            _, data = _read(self._path(name))
+        if not data:
             raise _EmptyFile
-        if not os.path.exists(path):
-            return default
-        with self._open(name) as var:
-            return var.read().strip("\n").replace("\x00", "\n")
+        return _decode(data, self._encoding())
+
+    def _encoding(self):
+        return None if self.binary else _encoding()
+
+    def _state(self, name):
+        if name in self.data:
+            return self.data[name]
+        return None if name in self._unset else _sentinel
+
+    def _changed(self, name, old):
+        # keeps the digest of fingerprint() up to date
+        if self._digest is not None:
+            self._digest ^= _digest(name, old) ^ _digest(name, self._state(name))
 
     def _set(self, name, value):
-        if name in os.environ:
-            self.originals[name] = os.environ[name]
+        old = self._state(name)
+        if name in self._parsed:
+            del self._parsed[name]
+        if self._apply:
+            key = self._key(name)
+            if name not in self.data and key in self._environ:
+                # not when changing a value set by this envdir before
+                self.originals[name] = self._environ[key]
+            self._environ[key] = value
         self.data[name] = value
-        os.environ[name] = value
+        self._unset.discard(name)
+        self._exec_env = None
+        self._changed(name, old)
 
     def _delete(self, name):
-        if name in self.originals:
-            os.environ[name] = self.originals[name]
-        elif name in os.environ:
-            del os.environ[name]
+        old = self._state(name)
+        if name in self._parsed:
+            del self._parsed[name]
+        if self._apply:
+            key = self._key(name)
+            if name in self.originals:
+                self._environ[key] = self.originals[name]
+            elif key in self._environ:
+                del self._environ[key]
         if name in self.data:
             del self.data[name]
+        self._unset.discard(name)
+        self._exec_env = None
+        self._changed(name, old)
+
+    def _empty(self, name):
+        key = self._key(name)
+        if self._apply and name not in self.data and key in self._environ:
+            # unset by the empty file, restored by clear()
+            self.originals.setdefault(name, self._environ[key])
+        self._delete(name)
+        if self._apply:
+            self._environ.pop(key, None)
+        self._unset.add(name)
+        self._changed(name, _sentinel)
 
     def _write(self, **values):
-        for name, value in values.items():
-            with self._open(name, "w") as env:
-                env.write(value)
+        """
+        Writes the given values (or removes the files of the ones which
+        are None) by writing them to a temporary directory next to their
+        files first and renaming them into place, so readers never see
+        partially written files. Symlinked variables are written through
+        to the files they point to. The directories are synced once at the
+        end.
+        """
+        import tempfile
+
+        if self._pack is not None:
+            raise ValueError("can't write to the pack %s, unpack it first" % self.path)
+        # the directories of the written files, mapped to the temporary
+        # directories inside them
+        staging = {}
+        try:
+            written = []
+            for name, value in values.items():
+                if value is None:
+                    continue
+                target = os.path.realpath(os.path.join(self.path, name))
+                directory = os.path.dirname(target)
+                if directory not in staging:
+                    staging[directory] = tempfile.mkdtemp(
+                        prefix=".envdir-", dir=directory
+                    )
+                staged = os.path.join(staging[directory], os.path.basename(target))
+                with open(staged, "wb" if isinstance(value, bytes) else "w") as env:
+                    env.write(value)
+                try:
+                    # keep the permissions of e.g. secrets
+                    os.chmod(staged, os.stat(target).st_mode & 0o7777)
+                except FileNotFoundError:
+                    pass
+                written.append((staged, target))
+            for staged, target in written:
+                replace(staged, target)
+            for name, value in values.items():
+                target = os.path.join(self.path, name)
+                if value is None and os.path.lexists(target):
+                    os.remove(target)
+            for directory in set(staging).union([os.path.realpath(self.path)]):
+                _fsync_dir(directory)
+        finally:
+            for tmp in staging.values():
+                for name in os.listdir(tmp):
+                    os.remove(os.path.join(tmp, name))
+                os.rmdir(tmp)
+
+    def _commit(self, staged):
+        self._write(**staged)
+        for name, value in staged.items():
+            if len(self.paths) > 1:
+                self._index.pop(name, None)
+            if value is None:
+                if len(self.paths) > 1:
+                    self._reload(name)
+                else:
+                    self._delete(name)
+            else:
+                self._set(name, value)
+                self.created[name] = value
+
+    def update(self, *args, **kwargs):
+        """
+        Writes all given values in a single transaction.
+        """
+        with self.transaction():
+            for name, value in dict(*args, **kwargs).items():
+                self[name] = value
+
+    def transaction(self):
+        """
+        Returns a context manager which stages all writes and deletions
+        done to this envdir inside its block and publishes them together
+        when the block is left without an exception (and discards them
+        otherwise). Staged values are not visible before that::
+
+            with env.transaction():
+                env['DATABASE_URL'] = 'sqlite://:memory:'
+                del env['CACHE_URL']
+        """
+        return _Transaction(self)
+
+    def apply(self):
+        """
+        Reads all variables not read yet in lazy mode and applies them to
+        os.environ (unless the Env was created with ``apply=False``).
+        """
+        for name in list(self._pending):
+            self._resolve(name)
+        return self
+
+    def overlay(self, **values):
+        """
+        Returns an :class:`Overlay` of the variables of the envdir, updated
+        by the given values (None to unset), to apply them to os.environ
+        for a while, e.g. in tests, without reading the envdir again. Best
+        used with an Env created with ``apply=False``.
+        """
+        self.apply()
+        merged = dict.fromkeys(self._unset)
+        if self.binary and bytes is not str:
+            # the same bytes in os.environb
+            merged.update(
+                (name, os.fsdecode(value)) for name, value in self.data.items()
+            )
+        else:
+            merged.update(self.data)
+        merged.update(values)
+        return Overlay(merged)
+
+    def _typed(self, name, key, parse, default):
+        """
+        Returns the value of a variable as parsed by parse, which is done
+        once and cached (by name and key) until the variable changes.
+        """
+        if name in self._pending:
+            self._resolve(name)
+        if name not in self.data:
+            if default is _sentinel:
+                raise KeyError(name)
+            return default
+        parsed = self._parsed.setdefault(name, {})
+        if key not in parsed:
+            value = self.data[name]
+            if isinstance(value, bytes) and bytes is not str:
+                value = value.decode(_encoding())
+            try:
+                parsed[key] = parse(value)
+            except ValueError as err:
+                raise ValueError("invalid value of %s: %s" % (name, err))
+        return parsed[key]
+
+    def get_int(self, name, default=_sentinel):
+        """
+        Returns the value of a variable as an integer, or default if it
+        isn't set (raises KeyError without a default). Raises ValueError if
+        it isn't an integer.
+
+        Like the other typed getters, the value is taken from the variables
+        as loaded (and kept up to date by writes, :meth:`refresh` and
+        :meth:`watch`) and only parsed again after it changed.
+        """
+        return self._typed(name, "int", int, default)
+
+    def get_bool(self, name, default=_sentinel):
+        """
+        Returns the value of a variable as a boolean: ``1``, ``true``,
+        ``yes`` and ``on`` are true, ``0``, ``false``, ``no``, ``off`` and
+        empty values are false, ignoring case. See :meth:`get_int`.
+        """
+        return self._typed(name, "bool", _parse_bool, default)
+
+    def get_list(self, name, sep=",", default=_sentinel):
+        """
+        Returns the value of a variable split at sep, with whitespace
+        stripped from the items, as a tuple. See :meth:`get_int`.
+        """
+        return self._typed(name, ("list", sep), _parse_list(sep), default)
+
+    def get_json(self, name, default=_sentinel):
+        """
+        Returns the value of a variable parsed as JSON. The result is shared
+        by all calls until the variable changes, so don't modify it. See
+        :meth:`get_int`.
+        """
+        return self._typed(name, "json", _parse_json, default)
+
+    def get_url(self, name, default=_sentinel):
+        """
+        Returns the value of a variable parsed as a URL, as returned by
+        :func:`urllib.parse.urlsplit`. See :meth:`get_int`.
+        """
+        return self._typed(name, "url", _parse_url, default)
+
+    def fingerprint(self, fast=False):
+        """
+        Returns a digest of the variables of the envdir as a hex string,
+        which changes whenever a variable is set, changed or unset. It is
+        computed from the SHA-256 digests of the names and values once and
+        then kept up to date as variables change, e.g. by
+        :meth:`refresh`. With ``fast`` the envdir is listed instead and
+        only the names, inodes, modification times and sizes of the files
+        are hashed, see :func:`envdir.env.digest`.
+        """
+        if fast:
+            return digest(self.paths, fast=True)
+        if self._digest is None:
+            self.apply()
+            result = 0
+            for name, value in self.data.items():
+                result ^= _digest(name, value)
+            for name in self._unset:
+                result ^= _digest(name, None)
+            self._digest = result
+        return "%064x" % self._digest
+
+    def as_exec_env(self):
+        """
+        Returns the environment for child processes: a read-only mapping
+        (a dict before Python 3.3, not to be changed either) of os.environ
+        merged with the variables of the envdir. It is built once and
+        reused until a variable of the envdir changes, pass it to
+        os.execve, os.posix_spawn or subprocess, or use :meth:`spawn`.
+        """
+        if self._exec_env is None:
+            try:
+                from types import MappingProxyType
+            except ImportError:  # <python3.3, a copy instead
+                MappingProxyType = dict
+
+            self.apply()
+            environ = dict(self._environ)
+            for name in self._unset:
+                environ.pop(self._key(name), None)
+            environ.update(
+                (self._key(name), value) for name, value in self.data.items()
+            )
+            self._exec_env = MappingProxyType(environ)
+        return self._exec_env
+
+    def spawn(self, argv):
+        """
+        Starts the program ``argv[0]``, looked up in the ``PATH`` of
+        :meth:`as_exec_env` like ``envdir`` does, with the arguments argv
+        in that environment and returns its process id (a process handle on
+        Windows), without changing os.environ.
+        """
+        environ = self.as_exec_env()
+        if not hasattr(os, "posix_spawn"):  # <python3.8 or Windows
+            return os.spawnvpe(os.P_NOWAIT, argv[0], argv, environ)
+        executable = argv[0]
+        if not os.path.dirname(executable):
+            from shutil import which
+
+            path = environ.get(self._key("PATH"))
+            if isinstance(path, bytes):
+                path = os.fsdecode(path)
+            executable = which(executable, path=path or os.defpath)
+            if executable is None:
+                raise OSError(errno.ENOENT, "No such file or directory", argv[0])
+        return os.posix_spawn(executable, argv, environ)
+
+    def watch(self, callback=None, interval=1.0):
+        """
+        Starts watching the envdir for changes in a background thread and
+        returns the :class:`~envdir.watch.Watcher`. Created, modified and
+        removed files are reread (and applied to os.environ) one by one,
+        using inotify on Linux and polling every ``interval`` seconds
+        elsewhere. ``callback`` is called with the Env, the name, the old
+        and the new value (None if unset) of every changed variable.
+        """
+        from .watch import Watcher
+
+        if self._pack is not None:
+            raise ValueError("packs can't be watched, use refresh() instead")
+        if self._watcher is None:
+            self._watcher = Watcher(self, interval=interval)
+            self._watcher.start()
+        if callback is not None:
+            self._watcher.callbacks.append(callback)
+        return self._watcher
 
     def clear(self):
         """
@@ -113,5 +1229,56 @@ class Env(UserDict):
         values it had before opening this envdir (or removing them
         if they didn't exist). Doesn't delete the envdir files.
         """
-        for name in list(self.data.keys()):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        if self._pack is not None:
+            self._pack.close()
+        self._pending.clear()
+        for name in list(self.data.keys()) + list(self._unset):
             self._delete(name)
+        self._unset.clear()
+        self._digest = None
+        self._parsed.clear()
+
+
+class ReadOnlyEnv(Mapping):
+    """
+    An immutable mapping of the variables of an envdir (or of layered
+    envdirs) which doesn't change os.environ, see :func:`envdir.read_only`.
+    The names and values are kept in two tuples, sorted by name.
+    """
+
+    __slots__ = ("paths", "_names", "_values")
+
+    def __init__(self, path, workers=1):
+        paths = list(path) if isinstance(path, (list, tuple)) else [path]
+        if not paths:
+            raise ValueError("at least one envdir path is required")
+        items = sorted(
+            (name, value)
+            for name, _, value in _scan_layers(paths, workers)
+            if value is not None
+        )
+        self.paths = tuple(paths)
+        self._names = tuple(name for name, _ in items)
+        self._values = tuple(value for _, value in items)
+
+    @property
+    def path(self):
+        return self.paths[-1]
+
+    def __repr__(self):
+        return "<envdir.ReadOnlyEnv '%s'>" % os.pathsep.join(self.paths)
+
+    def __getitem__(self, name):
+        index = bisect_left(self._names, name)
+        if index < len(self._names) and self._names[index] == name:
+            return self._values[index]
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
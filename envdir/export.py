@@ -0,0 +1,87 @@
+"""
+Printing the variables of envdirs for other programs, e.g. shells, to
+load them without running envdir for every single process, see
+``envdir --export``.
+
+Every format is a function returning the text of one variable, given its
+name and value, where None stands for a variable unset by an empty file.
+"""
+
+import json
+
+# the characters of variable names shells accept
+_identifier = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_"
+)
+
+
+def is_identifier(name):
+    return bool(name) and not name[0].isdigit() and _identifier.issuperset(name)
+
+
+def sh(name, value):
+    if not is_identifier(name):
+        # can't be set by a POSIX shell
+        return ""
+    if value is None:
+        return "unset %s\n" % name
+    return "export %s='%s'\n" % (name, value.replace("'", "'\\''"))
+
+
+def fish(name, value):
+    if not is_identifier(name):
+        return ""
+    if value is None:
+        return "set -e %s\n" % name
+    value = value.replace("\\", "\\\\").replace("'", "\\'")
+    return "set -gx %s '%s'\n" % (name, value)
+
+
+def dotenv(name, value):
+    if value is None:
+        # dotenv files can't unset variables
+        return ""
+    if "'" not in value and "\n" not in value:
+        # taken literally, without expanding e.g. $HOME
+        return "%s='%s'\n" % (name, value)
+    for char, escaped in [("\\", "\\\\"), ('"', '\\"'), ("\n", "\\n"), ("$", "$$")]:
+        value = value.replace(char, escaped)
+    return '%s="%s"\n' % (name, value)
+
+
+def null(name, value):
+    # like env -0, values may contain newlines
+    if value is None:
+        return ""
+    return "%s=%s\0" % (name, value)
+
+
+formats = {"sh": sh, "fish": fish, "dotenv": dotenv, "null": null}
+
+
+def export(paths, format="sh", stream=None, workers=1):
+    """
+    Writes the variables of the (layered) envdirs at the given paths to
+    the given stream (sys.stdout by default) in one of the ``formats`` or
+    as a JSON object, while reading them from disk.
+    """
+    from .env import _scan_layers
+
+    if stream is None:
+        import sys
+
+        stream = sys.stdout
+    values = _scan_layers(paths, workers)
+    if format == "json":
+        separator = "{"
+        for name, _, value in values:
+            stream.write("%s%s: %s" % (separator, json.dumps(name), json.dumps(value)))
+            separator = ", "
+        stream.write("{}\n" if separator == "{" else "}\n")
+        return
+    try:
+        formatter = formats[format]
+    except KeyError:
+        raise ValueError("unknown export format %r" % format)
+    for name, _, value in values:
+        stream.write(formatter(name, value))
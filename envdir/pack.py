@@ -0,0 +1,230 @@
+"""
+Packed envdirs: the variable files of an envdir in a single file.
+
+A pack starts with a header and an index of one fixed size entry per
+variable, sorted by name, followed by the names and the raw contents of
+the files. It is memory mapped and single variables are looked up by a
+binary search of the index, without reading the rest of the pack. The
+contents are decoded the same way as the files of an envdir, so loading a
+pack results in the same variables as loading the envdir it was made of.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+from .env import (
+    _decode,
+    _encoding,
+    _fsdecode,
+    _fsencode,
+    _merge,
+    _read_many,
+    fingerprint,
+    isenvvar,
+)
+
+try:
+    replace = os.replace
+except AttributeError:  # <python3.3
+    replace = os.rename
+
+MAGIC = b"ENVDIRP\x01"
+
+# magic, number of variables
+_header = struct.Struct("<8sI")
+# offset and length of the name, offset and length of the content
+_entry = struct.Struct("<IIII")
+
+
+def is_pack(path):
+    """
+    Whether the file at path is a pack.
+    """
+    try:
+        with open(path, "rb") as pack:
+            return pack.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+class Pack(object):
+    """
+    The memory mapped pack at path, which is opened and mapped once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as pack:
+            stat = os.fstat(pack.fileno())
+            if stat.st_size < _header.size:
+                raise ValueError("%s is not an envdir pack" % path)
+            self._buf = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stat = stat
+        magic, self._count = _header.unpack_from(self._buf)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not an envdir pack" % path)
+        try:
+            if _header.size + self._count * _entry.size > len(self._buf):
+                raise ValueError("%s is a truncated envdir pack" % path)
+            if self._count:
+                # the content of the last variable ends the pack
+                self._entry(self._count - 1)
+        except ValueError:
+            self.close()
+            raise
+
+    def __repr__(self):
+        return "<envdir.Pack %r of %d variables>" % (self.path, self._count)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def fingerprint(self):
+        return fingerprint(self.stat)
+
+    def _entry(self, index):
+        """
+        The name and the offset and size of the content of an entry.
+        Raises a ValueError if they are beyond the end of the pack, as
+        slicing the mapping would silently cut them short.
+        """
+        name_offset, name_len, offset, size = _entry.unpack_from(
+            self._buf, _header.size + index * _entry.size
+        )
+        end = name_offset + name_len
+        if max(end, offset + size) > len(self._buf):
+            raise ValueError("%s is a truncated envdir pack" % self.path)
+        return self._buf[name_offset:end], offset, size
+
+    def _name(self, index):
+        return self._entry(index)[0]
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield _fsdecode(self._name(index))
+
+    def get(self, name):
+        """
+        Returns the raw content of the file of the variable, raises a
+        KeyError if there is none.
+        """
+        key = _fsencode(name)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            found, offset, size = self._entry(low)
+            if found == key:
+                end = offset + size
+                return self._buf[offset:end]
+        raise KeyError(name)
+
+    def sizes(self):
+        """
+        Yields the names and sizes of the files of the variables.
+        """
+        for index in range(self._count):
+            name, _, size = self._entry(index)
+            yield _fsdecode(name), size
+
+    def items(self):
+        """
+        Yields the names and raw contents of the files of the variables.
+        """
+        for index in range(self._count):
+            name, offset, size = self._entry(index)
+            end = offset + size
+            yield _fsdecode(name), self._buf[offset:end]
+
+    def close(self):
+        self._buf.close()
+
+
+def scan(path, binary=False):
+    """
+    Like :func:`envdir.env._scan` for the pack at path: yields the name,
+    stat result of the pack and value of every variable.
+    """
+    encoding = None if binary else _encoding()
+    pack = Pack(path)
+    try:
+        for name, data in pack.items():
+            yield name, pack.stat, _decode(data, encoding) if data else None
+    finally:
+        pack.close()
+
+
+def dump(items):
+    """
+    The pack of the given (name, raw content) pairs.
+    """
+    items = sorted((_fsencode(name), data) for name, data in items)
+    offset = _header.size + len(items) * _entry.size
+    index = [_header.pack(MAGIC, len(items))]
+    chunks = []
+    for name, data in items:
+        index.append(_entry.pack(offset, len(name), offset + len(name), len(data)))
+        chunks.append(name)
+        chunks.append(data)
+        offset += len(name) + len(data)
+    return b"".join(index + chunks)
+
+
+def pack(paths, output, workers=1):
+    """
+    Writes the variable files of the (layered) envdirs at paths to the pack
+    at output, atomically replacing it. Returns the number of variables.
+    """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    entries = list(_merge(paths).values())
+    items = []
+    for entry, (_, data) in zip(
+        entries, _read_many([entry.path for entry in entries], workers)
+    ):
+        if not isinstance(data, bytes):
+            mapped = data
+            try:
+                data = mapped[:]
+            finally:
+                mapped.close()
+        items.append((entry.name, data))
+    fd, tmp = tempfile.mkstemp(
+        prefix=".tmp-", dir=os.path.dirname(os.path.abspath(output))
+    )
+    try:
+        with os.fdopen(fd, "wb") as packed:
+            packed.write(dump(items))
+        replace(tmp, output)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return len(items)
+
+
+def unpack(path, directory):
+    """
+    Writes the variables of the pack at path as files to the envdir at
+    directory, which is created if necessary. Returns the number of
+    variables.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pack = Pack(path)
+    try:
+        for name, data in pack.items():
+            if not isenvvar(name) or os.path.basename(name) != name:
+                raise ValueError("invalid variable name %r in %s" % (name, path))
+            with open(os.path.join(directory, name), "wb") as variable:
+                variable.write(data)
+        return len(pack)
+    finally:
+        pack.close()
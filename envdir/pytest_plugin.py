@@ -0,0 +1,59 @@
+"""
+A pytest plugin applying an envdir to the tests which use the
+``envdir_environ`` fixture, reading it only once per session, see
+:class:`envdir.Overlay`.
+"""
+
+import os
+
+import pytest
+
+from .env import Env, Overlay
+from .runner import runner
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--envdir",
+        dest="envdir",
+        default=None,
+        help="the envdir to apply to the tests using the envdir_environ fixture",
+    )
+    parser.addini(
+        "envdir", "the envdir to apply to the tests using the envdir_environ fixture"
+    )
+
+
+@pytest.fixture(scope="session")
+def envdir_session(request):
+    """
+    The envdir given with ``--envdir`` or the ``envdir`` ini option (or the
+    :file:`envdir` directory in the rootdir, if any), read once per session
+    without applying it. None if there is none.
+    """
+    path = request.config.getoption("envdir") or request.config.getini("envdir")
+    if not path:
+        path = os.path.join(str(request.config.rootdir), "envdir")
+        if not os.path.isdir(path):
+            return None
+    paths = runner.paths(path)
+    return Env(paths if len(paths) > 1 else paths[0], apply=False)
+
+
+@pytest.fixture
+def envdir_environ(envdir_session):
+    """
+    Applies the variables of the session's envdir to os.environ during the
+    test and returns a function to apply more variables (None to unset),
+    all of which are restored after the test.
+    """
+    if envdir_session is None:
+        base = Overlay()
+    else:
+        base = envdir_session.overlay()
+
+    def apply(**values):
+        return Overlay(values).push()
+
+    with base:
+        yield apply
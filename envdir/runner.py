@@ -1,11 +1,6 @@
-import optparse
 import os
-import subprocess
 import sys
 
-from .env import Env
-from .version import __version__
-
 
 class Response(Exception):
     def __init__(self, message="", status=0):
@@ -13,60 +8,404 @@ class Response(Exception):
         self.status = status
 
 
+class Options(object):
+    """
+    The values of the command line options, like optparse.Values.
+    """
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
 class Runner(object):
-    envdir_usage = "usage: %prog [--help] [--version] dir child"
-    envshell_usage = "usage: %prog [--help] [--version] dir"
+    envdir_usage = (
+        "usage: %prog [--help] [--version] [options] dir[:dir...] child\n"
+        "       %prog --export [--format=FORMAT] dir[:dir...]\n"
+        "       %prog --fingerprint [--fast] dir[:dir...]\n"
+        "       %prog serve [--socket=PATH]\n"
+        "       %prog pack -o FILE dir[:dir...]\n"
+        "       %prog unpack -o DIR FILE"
+    )
+    envshell_usage = "usage: %prog [--help] [--version] [options] dir[:dir...]"
+    serve_usage = "usage: envdir serve [--help] [--socket=PATH]"
+    pack_usage = "usage: envdir pack [--help] -o FILE dir[:dir...]"
+    unpack_usage = "usage: envdir unpack [--help] -o DIR FILE"
+
+    # the names of the envdirs looked for by discover()
+    discover_names = ("envdir", ".envdir", "env")
+
+    # the files and directories marking the root of a repository, where
+    # discover() stops looking for envdirs in parent directories
+    discover_boundaries = (".git", ".hg", ".svn", ".bzr")
+
+    # the subcommands of envdir, used unless a directory of the same name
+    # exists, mapped to the names of their methods
+    commands = {"serve": "serve", "pack": "pack", "unpack": "unpack"}
+
+    # the command line options of all commands as (flags, keyword
+    # arguments) pairs for optparse.OptionParser.add_option
+    options = [
+        (
+            ["--no-cache"],
+            dict(
+                action="store_false",
+                dest="cache",
+                help="don't use the snapshot cache enabled by $ENVDIR_CACHE",
+            ),
+        ),
+        (
+            ["--rebuild-cache"],
+            dict(
+                action="store_true",
+                dest="rebuild_cache",
+                default=False,
+                help="rebuild the snapshot cache of the envdir",
+            ),
+        ),
+        (
+            ["--trace"],
+            dict(
+                action="store_true",
+                dest="trace",
+                default=False,
+                help="write timings of loading the envdir to stderr as JSON lines, "
+                "like ENVDIR_TRACE=1",
+            ),
+        ),
+    ]
+
+    # the additional options of single commands
+    command_options = {
+        "envdir": [
+            (
+                ["--export"],
+                dict(
+                    action="store_true",
+                    dest="export",
+                    default=False,
+                    help="print the variables of the envdir instead of running a child",
+                ),
+            ),
+            (
+                ["--format"],
+                dict(
+                    type="choice",
+                    choices=["sh", "fish", "json", "dotenv", "null"],
+                    dest="format",
+                    default="sh",
+                    help="the format of --export: sh (default), fish, json, "
+                    "dotenv or null (NUL separated NAME=value pairs)",
+                ),
+            ),
+            (
+                ["--fingerprint"],
+                dict(
+                    action="store_true",
+                    dest="fingerprint",
+                    default=False,
+                    help="print a digest of the variables of the envdir",
+                ),
+            ),
+            (
+                ["--fast"],
+                dict(
+                    action="store_true",
+                    dest="fast",
+                    default=False,
+                    help="compute the --fingerprint from the names, inodes, "
+                    "mtimes and sizes of the files without reading them",
+                ),
+            ),
+            (
+                ["--binary"],
+                dict(
+                    action="store_true",
+                    dest="binary",
+                    default=False,
+                    help="apply the values as bytes, without decoding them",
+                ),
+            ),
+            (
+                ["--via-daemon"],
+                dict(
+                    action="store_true",
+                    dest="via_daemon",
+                    default=False,
+                    help="get the variables from the daemon started by "
+                    "'envdir serve' if it is running",
+                ),
+            ),
+        ],
+        "serve": [
+            (
+                ["-s", "--socket"],
+                dict(
+                    dest="socket",
+                    help="the Unix socket to listen at, $ENVDIR_SOCKET or "
+                    "envdir-UID.sock in $XDG_RUNTIME_DIR by default",
+                ),
+            ),
+        ],
+        "pack": [
+            (
+                ["-o", "--output"],
+                dict(dest="output", help="the pack file to write"),
+            ),
+        ],
+        "unpack": [
+            (
+                ["-o", "--output"],
+                dict(dest="output", help="the envdir to write the variables to"),
+            ),
+        ],
+        "envshell": [
+            (
+                ["-e", "--exec"],
+                dict(
+                    action="store_true",
+                    dest="exec_shell",
+                    default=False,
+                    help="replace envshell with the shell instead of waiting for it",
+                ),
+            ),
+            (
+                ["-c", "--command"],
+                dict(
+                    dest="command",
+                    help="let the shell run COMMAND and exit, implies --exec",
+                ),
+            ),
+            (
+                ["--rcfile"],
+                dict(dest="rcfile", help="pass --rcfile RCFILE to the shell"),
+            ),
+        ],
+    }
 
     def __init__(self):
-        self.parser = optparse.OptionParser(version=__version__)
-        self.parser.disable_interspersed_args()
-        self.parser.prog = "envdir"
+        self._parsers = {}
+        # the discovered envdirs by caller directory and names
+        self._discovered = {}
+
+    def option_list(self, prog):
+        return self.options + self.command_options.get(prog, [])
+
+    def get_parser(self, prog):
+        # optparse is only imported when there are options to parse
+        if prog not in self._parsers:
+            import optparse
+
+            from .version import __version__
+
+            parser = optparse.OptionParser(version=__version__)
+            parser.disable_interspersed_args()
+            parser.prog = prog
+            for flags, kwargs in self.option_list(prog):
+                parser.add_option(*flags, **kwargs)
+            self._parsers[prog] = parser
+        return self._parsers[prog]
+
+    @property
+    def parser(self):
+        return self.get_parser("envdir")
+
+    def defaults(self, prog="envdir"):
+        return Options(
+            **dict(
+                (kwargs["dest"], kwargs.get("default"))
+                for _, kwargs in self.option_list(prog)
+            )
+        )
+
+    def parse_args(self, prog, usage, args, interspersed=False):
+        """
+        Parses the command line, skipping optparse for the common case of
+        a command line without any options (``envdir dir child``). Options
+        may follow the arguments if interspersed.
+        """
+        if (
+            not interspersed
+            and args
+            and (args[0] == "-" or not args[0].startswith("-"))
+        ):
+            return self.defaults(prog), args
+        parser = self.get_parser(prog)
+        parser.set_usage(usage)
+        if interspersed:
+            parser.enable_interspersed_args()
+        return parser.parse_args(args)
+
+    def usage_error(self, prog, usage):
+        parser = self.get_parser(prog)
+        parser.set_usage(usage)
+        return Response(
+            "%s\nError: incorrect number of arguments\n" % (parser.get_usage()),
+            2,
+        )
+
+    def env_options(self, options):
+        """
+        The keyword arguments for Env, based on the command line options
+        and the ENVDIR_CACHE, ENVDIR_WORKERS and ENVDIR_TRACE environment
+        variables.
+        """
+        if options.rebuild_cache:
+            kwargs = {"cache": True, "rebuild_cache": True}
+        else:
+            if options.cache is None:
+                enabled = os.environ.get("ENVDIR_CACHE", "").lower()
+                options.cache = enabled not in ("", "0", "false", "no")
+            kwargs = {"cache": options.cache}
+        workers = os.environ.get("ENVDIR_WORKERS")
+        if workers:
+            try:
+                kwargs["workers"] = int(workers)
+            except ValueError:
+                raise Response("invalid ENVDIR_WORKERS %r" % workers, 2)
+        trace = "1" if options.trace else os.environ.get("ENVDIR_TRACE")
+        if trace:
+            from .trace import Tracer
+
+            try:
+                kwargs["trace"] = Tracer.from_environ(trace)
+            except (IOError, OSError) as err:
+                raise Response("invalid ENVDIR_TRACE %r: %s" % (trace, err), 2)
+        if getattr(options, "binary", False):
+            # the snapshot cache holds decoded values
+            kwargs.update(binary=True, cache=False, rebuild_cache=False)
+        return kwargs
 
-    def path(self, path):
+    def path(self, path, layered=False):
         real_path = os.path.realpath(os.path.expanduser(path))
         if not os.path.exists(real_path):
             # use 111 error code to adher to envdir's standard
             raise Response("envdir %r does not exist" % path, 111)
         if not os.path.isdir(real_path):
+            from .pack import is_pack
+
+            if is_pack(real_path):
+                if layered:
+                    raise Response("pack %r can't be layered" % path, 111)
+                return real_path
             # use 111 error code to adher to envdir's standard
             raise Response("envdir %r not a directory" % path, 111)
         return real_path
 
-    def open(self, path=None, stacklevel=1):
+    def paths(self, path):
+        """
+        The real paths of layered envdirs, given as a list or as a string
+        separated by os.pathsep (e.g. ``base:prod``) unless that string is
+        the path of an existing directory. A pack can only be used on its
+        own, not as one of several layers.
+        """
+        if isinstance(path, (list, tuple)):
+            layers = path
+        elif os.pathsep in path and not os.path.isdir(os.path.expanduser(path)):
+            layers = [layer for layer in path.split(os.pathsep) if layer]
+        else:
+            return [self.path(path)]
+        return [self.path(layer, len(layers) > 1) for layer in layers]
+
+    def discover(self, directory, names=None):
+        """
+        The real path of the first envdir with one of the given names (see
+        discover_names) in directory or its parent directories, which stops
+        at the root of a repository or of a filesystem. Found envdirs are
+        memoized per directory and names, so repeated lookups don't touch
+        the filesystem. If none is found, the path of the first name in
+        directory is returned.
+        """
+        names = tuple(names or self.discover_names)
+        key = (directory, names)
+        if key in self._discovered:
+            return self._discovered[key]
+        current = os.path.abspath(directory)
+        while True:
+            for name in names:
+                candidate = os.path.join(current, name)
+                if os.path.isdir(candidate):
+                    found = self._discovered[key] = os.path.realpath(candidate)
+                    return found
+            if os.path.ismount(current) or any(
+                os.path.exists(os.path.join(current, boundary))
+                for boundary in self.discover_boundaries
+            ):
+                break
+            parent = os.path.dirname(current)
+            if parent == current:
+                break
+            current = parent
+        return os.path.join(directory, names[0])
+
+    def caller_path(self, stacklevel=1, discover=False, names=None):
+        """
+        The envdir next to the file of the caller stacklevel frames up
+        from the caller of this method, or with discover=True, the envdir
+        found by :meth:`discover` starting there.
+        """
+        frame = sys._getframe()
+
+        def get_parent(frame):
+            return frame.f_back
+
+        for _ in range(stacklevel + 1):
+            frame = get_parent(frame)
+        if frame is not None:
+            callerdir = os.path.dirname(frame.f_code.co_filename)
+        else:
+            # last holdout, assume cwd
+            callerdir = ""
+        if discover:
+            return self.discover(callerdir or os.curdir, names)
+        return os.path.join(callerdir, "envdir")
+
+    def _open_path(self, path, stacklevel, discover, names):
+        """
+        The path (or paths of layered envdirs) to open for the arguments of
+        open(), with stacklevel counted from its caller. Discovered envdirs
+        are real paths of directories already and not checked again.
+        """
         if path is None:
-            frame = sys._getframe()
+            path = self.caller_path(stacklevel + 1, discover, names)
+            if discover and path in self._discovered.values():
+                return path
+        paths = self.paths(path)
+        return paths if len(paths) > 1 else paths[0]
 
-            def get_parent(frame):
-                return frame.f_back
+    def open(self, path=None, stacklevel=1, discover=False, names=None, **options):
+        path = self._open_path(path, stacklevel, discover, names)
+        from .env import Env
 
-            for _ in range(stacklevel):
-                frame = get_parent(frame)
-            if frame is not None:
-                callerdir = os.path.dirname(frame.f_code.co_filename)
-                path = os.path.join(callerdir, "envdir")
-            else:
-                # last holdout, assume cwd
-                path = "envdir"
-        return Env(self.path(path))
+        return Env(path, **options)
+
+    def aopen(self, path=None, stacklevel=1, discover=False, names=None, **options):
+        # the caller is only known here, not once the coroutine runs
+        path = self._open_path(path, stacklevel, discover, names)
+        from .aio import aopen
+
+        return aopen(path, **options)
+
+    def read_only(self, path=None, stacklevel=1, discover=False, names=None, **options):
+        path = self._open_path(path, stacklevel, discover, names)
+        from .env import ReadOnlyEnv
+
+        return ReadOnlyEnv(path, **options)
 
     def shell(self, name, *args):
-        self.parser.set_usage(self.envshell_usage)
-        self.parser.prog = "envshell"
-        options, args = self.parser.parse_args(list(args))
+        options, args = self.parse_args("envshell", self.envshell_usage, list(args))
 
         if len(args) == 0:
-            raise Response(
-                "%s\nError: incorrect number of arguments\n"
-                % (self.parser.get_usage()),
-                2,
-            )
+            raise self.usage_error("envshell", self.envshell_usage)
 
-        sys.stdout.write(
-            "Launching envshell for %s. "
-            "Type 'exit' or 'Ctrl+D' to return.\n" % self.path(args[0])
-        )
-        sys.stdout.flush()
-        self.open(args[0], 2)
+        if options.command is None:
+            # scripted sessions shouldn't see the banner in their output
+            sys.stdout.write(
+                "Launching envshell for %s. "
+                "Type 'exit' or 'Ctrl+D' to return.\n"
+                % os.pathsep.join(self.paths(args[0]))
+            )
+            sys.stdout.flush()
+        self.open(args[0], 2, **self.env_options(options))
 
         if "SHELL" in os.environ:
             shell = os.environ["SHELL"]
@@ -75,29 +414,52 @@ class Runner(object):
         else:
             raise Response("Unable to detect current environment shell")
 
+        argv = [shell]
+        if options.rcfile is not None:
+            argv.extend(["--rcfile", options.rcfile])
+        if options.command is not None:
+            if os.path.basename(shell).lower().startswith("cmd"):
+                argv.extend(["/c", options.command])
+            else:
+                argv.extend(["-c", options.command])
+
+        status = 0
         try:
-            subprocess.call([shell])
+            if options.exec_shell or options.command is not None:
+                # like run, without keeping envshell around as the parent
+                os.execvpe(shell, argv, os.environ)
+            else:
+                import subprocess
+
+                status = subprocess.call(argv)
         except OSError as err:
             if err.errno == 2:
                 raise Response("Unable to find shell %s" % shell, status=err.errno)
             else:
                 raise Response("An error occurred: %s" % err, status=err.errno)
 
-        raise Response()
+        raise Response(status=status)
 
     def run(self, name, *args):
-        self.parser.set_usage(self.envdir_usage)
-        self.parser.prog = "envdir"
-        options, args = self.parser.parse_args(list(args))
+        if args and args[0] in self.commands and not os.path.isdir(args[0]):
+            return getattr(self, self.commands[args[0]])(name, *args[1:])
+
+        options, args = self.parse_args("envdir", self.envdir_usage, list(args))
+
+        if options.export:
+            return self.export(options, args)
+
+        if options.fingerprint:
+            return self.fingerprint(options, args)
 
         if len(args) < 2:
-            raise Response(
-                "%s\nError: incorrect number of arguments\n"
-                % (self.parser.get_usage()),
-                2,
-            )
+            raise self.usage_error("envdir", self.envdir_usage)
 
-        self.open(args[0], 2)
+        kwargs = self.env_options(options)
+        if options.via_daemon:
+            self.fetch(args[0], kwargs)
+        else:
+            self.open(args[0], 2, **kwargs)
 
         # the args to call later
         args = args[1:]
@@ -106,6 +468,9 @@ class Runner(object):
         if args[0] == "--":
             args = args[1:]
 
+        if kwargs.get("trace") is not None:
+            kwargs["trace"].execute(args[0])
+
         try:
             os.execvpe(args[0], args, os.environ)
         except OSError as err:
@@ -115,6 +480,101 @@ class Runner(object):
 
         raise Response()
 
+    def export(self, options, args):
+        if len(args) != 1:
+            raise self.usage_error("envdir", self.envdir_usage)
+
+        from .export import export
+
+        workers = self.env_options(options).get("workers", 1)
+        export(self.paths(args[0]), options.format, sys.stdout, workers)
+        sys.stdout.flush()
+
+        raise Response()
+
+    def fingerprint(self, options, args):
+        if len(args) != 1:
+            raise self.usage_error("envdir", self.envdir_usage)
+
+        from .env import digest
+
+        workers = self.env_options(options).get("workers", 1)
+        sys.stdout.write(digest(self.paths(args[0]), options.fast, workers) + "\n")
+        sys.stdout.flush()
+
+        raise Response()
+
+    def fetch(self, path, options):
+        """
+        Applies the variables of the envdirs at path as answered by the
+        daemon, or loads them directly with the given Env options if there
+        is no daemon.
+        """
+        from .daemon import fetch
+
+        values = fetch(self.paths(path))
+        if values is None:
+            return self.open(path, **options)
+        for name, value in values:
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def serve(self, name, *args):
+        options, args = self.parse_args("serve", self.serve_usage, list(args))
+
+        if args:
+            raise self.usage_error("serve", self.serve_usage)
+
+        import signal
+
+        from .daemon import Server
+
+        server = Server(options.socket)
+        try:
+            server.bind()
+        except (IOError, OSError) as err:
+            raise Response("Unable to start the envdir daemon: %s" % err, 1)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+
+        raise Response()
+
+    def pack(self, name, *args):
+        options, args = self.parse_args("pack", self.pack_usage, list(args), True)
+
+        if len(args) != 1 or not options.output:
+            raise self.usage_error("pack", self.pack_usage)
+
+        from .pack import pack
+
+        paths = self.paths(args[0])
+        try:
+            pack(paths, options.output, self.env_options(options).get("workers", 1))
+        except (IOError, OSError) as err:
+            raise Response("Unable to write pack %s: %s" % (options.output, err), 1)
+
+        raise Response()
+
+    def unpack(self, name, *args):
+        options, args = self.parse_args("unpack", self.unpack_usage, list(args), True)
+
+        if len(args) != 1 or not options.output:
+            raise self.usage_error("unpack", self.unpack_usage)
+
+        from .pack import unpack
+
+        try:
+            unpack(args[0], options.output)
+        except (IOError, OSError, ValueError) as err:
+            raise Response("Unable to unpack %s: %s" % (args[0], err), 1)
+
+        raise Response()
+
 
 def go(caller, *args):
     if not args:
@@ -1,15 +1,24 @@
+import errno
 import functools
+import json
 import os
 import platform
+import re
 import signal
+import socket
 import subprocess
 import sys
 import threading
+import time
 
 import py
 import pytest
 
 import envdir
+import envdir.cache
+import envdir.daemon
+import envdir.pack
+import envdir.watch
 from envdir.runner import Response
 
 try:
@@ -276,6 +285,49 @@ def test_shell_doesnt_exist(shell, tmpenvdir):
     assert "Unable to find shell" in response.value.message
 
 
+@pytest.mark.skipif(platform.system() == "Windows", reason="POSIX shells only")
+def test_shell_exit_status(shell, tmpenvdir, tmpdir, monkeypatch, capfd):
+    tmpenvdir.join("SHELL_STATUS").write("3")
+    script = tmpdir.join("status.sh")
+    script.write("#!/bin/sh\nexit $SHELL_STATUS\n")
+    script.chmod(0o755)
+    monkeypatch.setenv("SHELL", str(script))
+    with py.test.raises(Response) as response:
+        shell("envshell", str(tmpenvdir))
+    assert response.value.status == 3
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="POSIX shells only")
+def test_shell_exec(shell, tmpenvdir, monkeypatch, capfd):
+    tmpenvdir.join("SHELL_STATUS").write("4")
+    monkeypatch.setenv("SHELL", "/bin/sh")
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    with py.test.raises(Response) as response:
+        shell("envshell", "--exec", str(tmpenvdir))
+    out, err = capfd.readouterr()
+    assert "Launching envshell for " in out
+    assert response.value.status == 0
+
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    with py.test.raises(Response) as response:
+        shell("envshell", "--command", "exit $SHELL_STATUS", str(tmpenvdir))
+    out, err = capfd.readouterr()
+    assert "Launching envshell" not in out
+    assert response.value.status == 4
+
+
+def test_shell_rcfile(shell, tmpenvdir, monkeypatch):
+    calls = []
+    monkeypatch.setenv("SHELL", "/bin/bash")
+    monkeypatch.setattr(os, "execvpe", lambda *args: calls.append(args))
+    with py.test.raises(Response):
+        shell("envshell", "--rcfile", "rc", "-c", "true", str(tmpenvdir))
+    assert calls[0][:2] == (
+        "/bin/bash",
+        ["/bin/bash", "--rcfile", "rc", "-c", "true"],
+    )
+
+
 def test_read(tmpenvdir):
     tmpenvdir.join("READ").write("test")
     applied = envdir.read(str(tmpenvdir))
@@ -314,6 +366,45 @@ if 'READ_MAGIC' in os.environ:
     assert response.value.code == 2
 
 
+def test_discover(tmpdir, monkeypatch):
+    tmpdir.mkdir("envdir").join("DISCOVER").write("outside")
+    repo = tmpdir.mkdir("repo")
+    repo.mkdir(".git")
+    repo.mkdir(".envdir").join("DISCOVER").write("repo")
+    sub = repo.mkdir("package").mkdir("sub")
+    sub.join("script.py").write("""
+import envdir, os, sys
+envdir.open(discover=True)
+# the discovered envdir isn't checked again
+envdir.runner.path = None
+envdir.open(discover=True).clear()
+sys.exit(42 if os.environ['DISCOVER'] == 'repo' else 1)
+""")
+    assert subprocess.call([sys.executable, str(sub.join("script.py"))]) == 42
+
+    from envdir.runner import Runner
+
+    runner = Runner()
+    probed = []
+    original_isdir = os.path.isdir
+
+    def counting_isdir(path):
+        probed.append(path)
+        return original_isdir(path)
+
+    monkeypatch.setattr(os.path, "isdir", counting_isdir)
+    assert runner.discover(str(sub)) == os.path.realpath(str(repo.join(".envdir")))
+    assert probed
+    del probed[:]
+    assert runner.discover(str(sub)) == os.path.realpath(str(repo.join(".envdir")))
+    assert probed == []
+    # not looking beyond the root of the repository
+    assert runner.discover(str(sub), ["envdir"]) == str(sub.join("envdir"))
+    assert runner.discover(str(tmpdir.mkdir("other")), ["envdir"]) == (
+        os.path.realpath(str(tmpdir.join("envdir")))
+    )
+
+
 def test_read_existing_var(tmpenvdir):
     tmpenvdir.join("READ_EXISTING").write("override")
     os.environ["READ_EXISTING"] = "test"
@@ -330,6 +421,21 @@ def test_write(tmpenvdir):
     assert os.environ["WRITE"] == "test"
 
 
+@pytest.mark.skipif(platform.system() == "Windows", reason="No symlinks")
+def test_write_symlink(tmpenvdir, tmpdir):
+    "Writing a symlinked variable writes the file it points to"
+    shared = tmpdir.mkdir("shared").join("SHARED")
+    shared.write("shared")
+    tmpenvdir.join("WRITE_LINKED").mksymlinkto(shared)
+    with envdir.open(str(tmpenvdir)) as env:
+        env.update(WRITE_LINKED="changed", WRITE_PLAIN="plain")
+    assert tmpenvdir.join("WRITE_LINKED").islink()
+    assert shared.read() == "changed"
+    assert tmpenvdir.join("WRITE_PLAIN").read() == "plain"
+    assert sorted(os.listdir(str(tmpenvdir))) == ["WRITE_LINKED", "WRITE_PLAIN"]
+    assert os.listdir(str(tmpdir.join("shared"))) == ["SHARED"]
+
+
 def test_write_magic(tmpdir):
     tmp = tmpdir.mkdir("envdir")
     magic_scripts = tmpdir.join("test_magic_write.py")
@@ -446,3 +552,1173 @@ def test_envdir_raise_broken_symlinks(run, tmpenvdir, monkeypatch):
     tmpenvdir.join("SYMLINK_ENV").remove()
     with pytest.raises(FileNotFoundError):
         run("envdir", str(tmpenvdir), "ls")
+
+
+def test_subdirectories_are_skipped(tmpenvdir):
+    tmpenvdir.join("TOP_LEVEL").write("test")
+    tmpenvdir.mkdir("nested").join("NESTED_VAR").write("test")
+    with envdir.open(str(tmpenvdir)) as env:
+        assert list(env) == ["TOP_LEVEL"]
+        assert "NESTED_VAR" not in os.environ
+        assert "nested" not in os.environ
+
+
+def test_load_syscalls_per_variable(tmpenvdir, monkeypatch):
+    "Each variable is read with one open, fstat, read and close"
+    for index in range(10):
+        tmpenvdir.join("SYSCALL_%d" % index).write("value\n")
+    calls = []
+
+    def counting(name, original):
+        def counted(*args, **kwargs):
+            calls.append(name)
+            return original(*args, **kwargs)
+
+        return counted
+
+    for name in ["open", "fstat", "read", "close", "stat"]:
+        monkeypatch.setattr(os, name, counting(name, getattr(os, name)))
+    with envdir.Env(str(tmpenvdir)) as env:
+        monkeypatch.undo()
+        assert env["SYSCALL_3"] == "value"
+    for name in ["open", "fstat", "read", "close"]:
+        assert calls.count(name) == 10
+    assert "stat" not in calls
+
+
+def age_envdir(path, seconds=60):
+    "Moves the mtimes of the envdir and its files into the past"
+    mtime = time.time() - seconds
+    for child in path.listdir():
+        os.utime(str(child), (mtime, mtime))
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_snapshot_cache(tmpenvdir, tmpdir, monkeypatch):
+    cache = tmpdir.join("snapshot.cache")
+    tmpenvdir.join("CACHED").write("test")
+    tmpenvdir.join("CACHED_EMPTY").write("")
+    age_envdir(tmpenvdir)
+    with envdir.Env(str(tmpenvdir), cache=str(cache)) as env:
+        assert env.data == {"CACHED": "test"}
+    assert cache.check()
+
+    def fail(path):
+        raise AssertionError("read %s instead of the snapshot" % path)
+
+    monkeypatch.setattr("envdir.env._read", fail)
+    with envdir.Env(str(tmpenvdir), cache=str(cache)) as env:
+        assert env.data == {"CACHED": "test"}
+    monkeypatch.undo()
+
+    # changing a file in place invalidates the snapshot
+    tmpenvdir.join("CACHED").write("changed")
+    with envdir.Env(str(tmpenvdir), cache=str(cache)) as env:
+        assert env.data == {"CACHED": "changed"}
+
+
+def test_snapshot_cache_corrupt(tmpenvdir, tmpdir):
+    cache = tmpdir.join("snapshot.cache")
+    cache.write("garbage")
+    tmpenvdir.join("CORRUPT_CACHE").write("test")
+    with envdir.Env(str(tmpenvdir), cache=str(cache)) as env:
+        assert env.data == {"CORRUPT_CACHE": "test"}
+
+
+def test_snapshot_cache_options(run, tmpenvdir, tmpdir, monkeypatch):
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("cache")))
+    tmpenvdir.join("CACHE_OPTION").write("test")
+    age_envdir(tmpenvdir)
+    cache = py.path.local(envdir.cache.cache_path(str(tmpenvdir)))
+
+    with py.test.raises(Response):
+        run("envdir", "--no-cache", str(tmpenvdir), "ls")
+    assert not cache.check()
+
+    monkeypatch.setenv("ENVDIR_CACHE", "1")
+    with py.test.raises(Response):
+        run("envdir", "--no-cache", str(tmpenvdir), "ls")
+    assert not cache.check()
+    with py.test.raises(Response):
+        run("envdir", str(tmpenvdir), "ls")
+    assert cache.check()
+
+    cache.write("stale")
+    monkeypatch.delenv("ENVDIR_CACHE")
+    with py.test.raises(Response):
+        run("envdir", "--rebuild-cache", str(tmpenvdir), "ls")
+    assert envdir.cache.Snapshot.read(str(cache)).values() == [("CACHE_OPTION", "test")]
+    assert os.environ["CACHE_OPTION"] == "test"
+
+
+# the most modules besides its own the fast path of envdir may import,
+# which unlike their import time doesn't depend on the machine
+IMPORT_BUDGET = 10
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="No true command on windows")
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime only")
+def test_startup_import_budget(tmpenvdir):
+    "Plain envdir calls import only a few modules, not optparse or subprocess"
+    tmpenvdir.join("STARTUP").write("test")
+    process = subprocess.Popen(
+        [sys.executable, "-X", "importtime", "-m", "envdir", str(tmpenvdir), "true"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(envdir.__file__))),
+        stderr=subprocess.PIPE,
+    )
+    _, stderr = process.communicate()
+    assert process.returncode == 0
+    names = [
+        line.split("|")[-1].rstrip()
+        for line in stderr.decode().splitlines()
+        if line.startswith("import time:") and "|" in line
+    ]
+    # top level imports come after their nested ones, so everything
+    # imported by the envdir package starts after the top level import
+    # before it
+    first = names.index(" envdir")
+    while first and names[first - 1][1] == " ":
+        first -= 1
+    names = [name.strip() for name in names[first:]]
+    own = [name for name in names if name.split(".")[0] == "envdir"]
+    assert set(own) == set(["envdir", "envdir.runner", "envdir.version", "envdir.env"])
+    others = [name for name in names if name not in own]
+    assert "optparse" not in others
+    assert "subprocess" not in others
+    assert len(others) <= IMPORT_BUDGET, others
+
+
+def test_lazy_env_module():
+    "envdir.env can still be used without importing it first"
+    script = "import envdir; assert 'env' in dir(envdir); envdir.env.Env"
+    assert subprocess.call(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(envdir.__file__))),
+    ) == 0
+
+
+def test_lazy(tmpenvdir, monkeypatch):
+    tmpenvdir.join("LAZY_ONE").write("one")
+    tmpenvdir.join("LAZY_TWO").write("two")
+    tmpenvdir.join("LAZY_EMPTY").write("")
+    monkeypatch.setenv("LAZY_EMPTY", "original")
+    with envdir.open(str(tmpenvdir), lazy=True) as env:
+        assert "LAZY_ONE" not in os.environ
+        assert "LAZY_ONE" in env
+        assert "LAZY_EMPTY" not in env
+        assert sorted(env) == ["LAZY_ONE", "LAZY_TWO"]
+        assert len(env) == 2
+        assert env["LAZY_ONE"] == "one"
+        assert os.environ["LAZY_ONE"] == "one"
+        assert "LAZY_TWO" not in os.environ
+        assert os.environ["LAZY_EMPTY"] == "original"
+        with pytest.raises(KeyError):
+            env["LAZY_EMPTY"]
+        assert "LAZY_EMPTY" not in os.environ
+    assert "LAZY_ONE" not in os.environ
+
+
+def test_lazy_apply(tmpenvdir):
+    tmpenvdir.join("LAZY_APPLY").write("test")
+    env = envdir.Env(str(tmpenvdir), lazy=True)
+    assert "LAZY_APPLY" not in os.environ
+    assert env.apply() is env
+    assert os.environ["LAZY_APPLY"] == "test"
+    assert dict(env.items()) == {"LAZY_APPLY": "test"}
+    env.clear()
+    assert "LAZY_APPLY" not in os.environ
+    assert list(env) == []
+
+
+def test_transaction(tmpenvdir):
+    tmpenvdir.join("TXN_DELETE").write("test")
+    with envdir.open(str(tmpenvdir)) as env:
+        with env.transaction():
+            env["TXN_ONE"] = "one"
+            env["TXN_TWO"] = "two"
+            del env["TXN_DELETE"]
+            assert not tmpenvdir.join("TXN_ONE").check()
+            assert tmpenvdir.join("TXN_DELETE").check()
+            assert "TXN_ONE" not in os.environ
+        assert tmpenvdir.join("TXN_ONE").read() == "one"
+        assert tmpenvdir.join("TXN_TWO").read() == "two"
+        assert not tmpenvdir.join("TXN_DELETE").check()
+        assert os.environ["TXN_TWO"] == "two"
+        assert "TXN_DELETE" not in os.environ
+        # no leftovers of the staging directory
+        assert sorted(child.basename for child in tmpenvdir.listdir()) == [
+            "TXN_ONE",
+            "TXN_TWO",
+        ]
+
+        with pytest.raises(ValueError):
+            with env.transaction():
+                env["TXN_ONE"] = "changed"
+                raise ValueError
+        assert tmpenvdir.join("TXN_ONE").read() == "one"
+        assert os.environ["TXN_ONE"] == "one"
+
+
+def test_update_syncs_once(tmpenvdir, monkeypatch):
+    tmpenvdir.join("UPDATE_0").write("secret")
+    tmpenvdir.join("UPDATE_0").chmod(0o600)
+    synced = []
+    original_fsync = os.fsync
+
+    def fsync(fd):
+        synced.append(fd)
+        return original_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    with envdir.open(str(tmpenvdir)) as env:
+        env.update(("UPDATE_%d" % index, str(index)) for index in range(50))
+        assert env["UPDATE_49"] == "49"
+        assert os.environ["UPDATE_0"] == "0"
+    assert len(synced) <= 1
+    assert len(tmpenvdir.listdir()) == 50
+    if sys.platform != "win32":
+        assert tmpenvdir.join("UPDATE_0").stat().mode & 0o777 == 0o600
+
+
+def wait_for_changes(env, count, **kwargs):
+    "Watches the env and returns a function waiting for count changes"
+    changes = []
+    done = threading.Event()
+
+    def callback(env, name, old, new):
+        changes.append((name, old, new))
+        if len(changes) >= count:
+            done.set()
+
+    env.watch(callback, **kwargs)
+
+    def wait():
+        assert done.wait(5), changes
+        return sorted(changes, key=lambda change: change[0])
+
+    return wait
+
+
+def make_watch_changes(tmpenvdir, atomic=False):
+    for name, value in [("WATCH_NEW", "new"), ("WATCH_MODIFIED", "modified")]:
+        if atomic:
+            # polling could see the file truncated but not written yet
+            staged = tmpenvdir.dirpath().join(name)
+            staged.write(value)
+            os.rename(str(staged), str(tmpenvdir.join(name)))
+        else:
+            tmpenvdir.join(name).write(value)
+    tmpenvdir.join("WATCH_REMOVED").remove()
+    tmpenvdir.join("WATCH_EMPTIED").write("")
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watch(tmpenvdir, monkeypatch, inotify):
+    if inotify and not envdir.watch.Inotify.available():
+        pytest.skip("inotify is not available")
+    monkeypatch.setattr(envdir.watch.Inotify, "available", lambda: inotify)
+    for name in ["WATCH_MODIFIED", "WATCH_REMOVED", "WATCH_EMPTIED"]:
+        tmpenvdir.join(name).write("original")
+    with envdir.open(str(tmpenvdir)) as env:
+        wait = wait_for_changes(env, 4, interval=0.05)
+        # give the polling watcher a chance to see differing mtimes
+        time.sleep(0.1)
+        make_watch_changes(tmpenvdir, atomic=not inotify)
+        assert wait() == [
+            ("WATCH_EMPTIED", "original", None),
+            ("WATCH_MODIFIED", "original", "modified"),
+            ("WATCH_NEW", None, "new"),
+            ("WATCH_REMOVED", "original", None),
+        ]
+        assert os.environ["WATCH_NEW"] == "new"
+        assert os.environ["WATCH_MODIFIED"] == "modified"
+        assert "WATCH_REMOVED" not in os.environ
+        assert "WATCH_EMPTIED" not in env.data
+    assert "WATCH_NEW" not in os.environ
+
+
+def test_watch_without_watches(tmpenvdir, monkeypatch):
+    "Out of inotify watches, the watcher polls instead"
+    if not envdir.watch.Inotify.available():
+        pytest.skip("inotify is not available")
+    closed = []
+    original_close = envdir.watch.Inotify.close
+
+    def close(self):
+        closed.append(self.fd)
+        original_close(self)
+
+    def add_watch(self, path, mask=None):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+
+    monkeypatch.setattr(envdir.watch.Inotify, "close", close)
+    monkeypatch.setattr(envdir.watch.Inotify, "add_watch", add_watch)
+    tmpenvdir.join("WATCH_POLLED").write("original")
+    with envdir.open(str(tmpenvdir)) as env:
+        wait = wait_for_changes(env, 1, interval=0.05)
+        assert env._watcher.inotify is None
+        assert len(closed) == 1
+        time.sleep(0.1)
+        tmpenvdir.join("WATCH_POLLED").write("modified")
+        assert wait() == [("WATCH_POLLED", "original", "modified")]
+
+
+def test_refresh(tmpenvdir, monkeypatch):
+    for index in range(10):
+        tmpenvdir.join("REFRESH_%d" % index).write("original")
+    monkeypatch.setenv("REFRESH_1", "outer")
+    monkeypatch.setenv("REFRESH_2", "outer")
+    with envdir.open(str(tmpenvdir)) as env:
+        assert env.refresh() == []
+        tmpenvdir.join("REFRESH_0").write("changed")
+        tmpenvdir.join("REFRESH_1").write("changed too")
+        tmpenvdir.join("REFRESH_2").remove()
+        tmpenvdir.join("REFRESH_3").write("")
+        tmpenvdir.join("REFRESH_NEW").write("new")
+
+        opened = []
+        original_open = os.open
+
+        def counting_open(path, *args, **kwargs):
+            opened.append(os.path.basename(path))
+            return original_open(path, *args, **kwargs)
+
+        monkeypatch.setattr(os, "open", counting_open)
+        changes = env.refresh()
+        monkeypatch.setattr(os, "open", original_open)
+
+        assert sorted(changes) == [
+            ("REFRESH_0", "original", "changed"),
+            ("REFRESH_1", "original", "changed too"),
+            ("REFRESH_2", "original", None),
+            ("REFRESH_3", "original", None),
+            ("REFRESH_NEW", None, "new"),
+        ]
+        assert sorted(opened) == ["REFRESH_0", "REFRESH_1", "REFRESH_3", "REFRESH_NEW"]
+        assert os.environ["REFRESH_0"] == "changed"
+        assert os.environ["REFRESH_1"] == "changed too"
+        # removed variables are reset to their original values
+        assert os.environ["REFRESH_2"] == "outer"
+        assert "REFRESH_3" not in os.environ
+    assert os.environ["REFRESH_1"] == "outer"
+    assert "REFRESH_0" not in os.environ
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="async/await only")
+def test_aopen(tmpenvdir, monkeypatch):
+    import asyncio
+    import envdir.aio
+
+    for index in range(20):
+        tmpenvdir.join("ASYNC_%d" % index).write("value %d" % index)
+    tmpenvdir.join("ASYNC_EMPTY").write("")
+    monkeypatch.setenv("ASYNC_0", "outer")
+    monkeypatch.setenv("ASYNC_EMPTY", "outer")
+
+    reading = []
+    most = []
+    original_reread = envdir.aio._reread
+
+    def slow_reread(path):
+        reading.append(path)
+        most.append(len(reading))
+        time.sleep(0.01)
+        reading.remove(path)
+        return original_reread(path)
+
+    monkeypatch.setattr(envdir.aio, "_reread", slow_reread)
+    loop = asyncio.new_event_loop()
+    try:
+        env = loop.run_until_complete(envdir.aopen(str(tmpenvdir), limit=4))
+        assert max(most) == 4
+        with envdir.open(str(tmpenvdir), apply=False) as expected:
+            assert env.data == expected.data
+        assert env.originals == {"ASYNC_0": "outer", "ASYNC_EMPTY": "outer"}
+        assert os.environ["ASYNC_0"] == "value 0"
+        assert "ASYNC_EMPTY" not in os.environ
+
+        tmpenvdir.join("ASYNC_1").write("changed")
+        tmpenvdir.join("ASYNC_2").remove()
+        changes = loop.run_until_complete(env.areload())
+        assert sorted(changes) == [
+            ("ASYNC_1", "value 1", "changed"),
+            ("ASYNC_2", "value 2", None),
+        ]
+        assert os.environ["ASYNC_1"] == "changed"
+        assert "ASYNC_2" not in os.environ
+        env.clear()
+    finally:
+        loop.close()
+    assert os.environ["ASYNC_0"] == "outer"
+    assert os.environ["ASYNC_EMPTY"] == "outer"
+    assert "ASYNC_1" not in os.environ
+
+
+@pytest.fixture
+def layers(tmpdir):
+    base = tmpdir.mkdir("base")
+    prod = tmpdir.mkdir("prod")
+    base.join("LAYER_BASE").write("base")
+    base.join("LAYER_OVERRIDDEN").write("base")
+    base.join("LAYER_UNSET").write("base")
+    prod.join("LAYER_OVERRIDDEN").write("prod")
+    prod.join("LAYER_UNSET").write("")
+    prod.join("LAYER_PROD").write("prod")
+    return base, prod
+
+
+def test_layers(layers, monkeypatch):
+    base, prod = layers
+    monkeypatch.setenv("LAYER_OVERRIDDEN", "original")
+    with envdir.Env([str(base), str(prod)]) as env:
+        assert env.data == {
+            "LAYER_BASE": "base",
+            "LAYER_OVERRIDDEN": "prod",
+            "LAYER_PROD": "prod",
+        }
+        assert env["LAYER_OVERRIDDEN"] == "prod"
+        assert os.environ["LAYER_OVERRIDDEN"] == "prod"
+        assert "LAYER_UNSET" not in os.environ
+        assert repr(env) == "<envdir.Env '%s%s%s'>" % (base, os.pathsep, prod)
+
+        env["LAYER_WRITTEN"] = "written"
+        assert prod.join("LAYER_WRITTEN").read() == "written"
+        # removing the file of the last envdir uncovers the earlier one
+        del env["LAYER_OVERRIDDEN"]
+        assert env["LAYER_OVERRIDDEN"] == "base"
+        assert os.environ["LAYER_OVERRIDDEN"] == "base"
+
+        prod.join("LAYER_BASE").write("prod")
+        assert env.refresh() == [("LAYER_BASE", "base", "prod")]
+    assert os.environ["LAYER_OVERRIDDEN"] == "original"
+    assert "LAYER_BASE" not in os.environ
+
+
+def test_layers_runner(run, layers, monkeypatch):
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    base, prod = layers
+    with py.test.raises(Response) as response:
+        run("envdir", os.pathsep.join([str(base), str(prod)]), "ls")
+    assert response.value.status == 0
+    assert os.environ["LAYER_BASE"] == "base"
+    assert os.environ["LAYER_OVERRIDDEN"] == "prod"
+    assert os.environ["LAYER_PROD"] == "prod"
+
+    with py.test.raises(Response) as response:
+        run("envdir", os.pathsep.join([str(base), str(prod) + "-missing"]), "ls")
+    assert "does not exist" in response.value.message
+    assert response.value.status == 111
+
+
+def test_workers(tmpenvdir, monkeypatch):
+    for index in range(40):
+        tmpenvdir.join("WORKERS_%d" % index).write("value %d\n" % index)
+    tmpenvdir.join("WORKERS_EMPTY").write("")
+    tmpenvdir.join("WORKERS_NULL").write("null\x00character\n\n")
+    monkeypatch.setenv("WORKERS_EMPTY", "original")
+    with envdir.Env(str(tmpenvdir)) as env:
+        serial = dict(env.data)
+    assert "WORKERS_EMPTY" not in serial
+
+    # a filesystem with slow opens, tracking how many overlap
+    active, overlapping = [], []
+    original_open = os.open
+
+    def slow_open(path, *args, **kwargs):
+        active.append(path)
+        overlapping.append(len(active))
+        time.sleep(0.005)
+        active.remove(path)
+        return original_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "open", slow_open)
+    monkeypatch.setenv("WORKERS_EMPTY", "original")
+    with envdir.Env(str(tmpenvdir), workers=8) as env:
+        assert env.data == serial
+        assert list(env.data) == list(serial)
+        assert env["WORKERS_NULL"] == "null\ncharacter"
+        assert "WORKERS_EMPTY" not in os.environ
+    assert max(overlapping) > 1
+
+
+def test_workers_option(run, tmpenvdir, monkeypatch):
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    tmpenvdir.join("WORKERS_OPTION").write("test")
+    monkeypatch.setenv("ENVDIR_WORKERS", "4")
+    with py.test.raises(Response) as response:
+        run("envdir", str(tmpenvdir), "ls")
+    assert response.value.status == 0
+    assert os.environ["WORKERS_OPTION"] == "test"
+
+    monkeypatch.setenv("ENVDIR_WORKERS", "many")
+    with py.test.raises(Response) as response:
+        run("envdir", str(tmpenvdir), "ls")
+    assert "invalid ENVDIR_WORKERS" in response.value.message
+    assert response.value.status == 2
+
+
+@pytest.fixture
+def exportenvdir(tmpenvdir):
+    tmpenvdir.join("EXPORT_SIMPLE").write("simple\n")
+    tmpenvdir.join("EXPORT_QUOTES").write('it\'s "quoted" $HOME `id` \\ \n')
+    tmpenvdir.join("EXPORT_NULL").write("multi\x00line\x00\n\n")
+    tmpenvdir.join("EXPORT_BLANK").write("\n")
+    tmpenvdir.join("EXPORT_UNICODE").write_text(u"\u00e9t\u00e9", encoding="utf-8")
+    tmpenvdir.join("EXPORT_EMPTY").write("")
+    tmpenvdir.join("EXPORT-DASH").write("dash")
+    with envdir.Env(str(tmpenvdir)) as env:
+        expected = dict((name, env._get(name)) for name in env)
+    assert expected["EXPORT_NULL"] == "multi\nline\n"
+    return tmpenvdir, expected
+
+
+def export(run, capfd, path, format):
+    with py.test.raises(Response) as response:
+        run("envdir", "--export", "--format=%s" % format, path)
+    assert response.value.status == 0
+    return capfd.readouterr()[0]
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="POSIX shells only")
+def test_export_sh(run, exportenvdir, capfd, tmpdir, monkeypatch):
+    path, expected = exportenvdir
+    if sys.getfilesystemencoding().lower().replace("-", "") != "utf8":
+        pytest.skip("UTF-8 locale required")
+    monkeypatch.setenv("EXPORT_EMPTY", "unset by the export")
+    script = tmpdir.join("export.sh")
+    script.write(export(run, capfd, str(path), "sh"))
+    dump = "import json, os, sys; sys.stdout.write(json.dumps(dict(os.environ)))"
+    output = subprocess.check_output(
+        ["sh", "-c", '. "$0" && exec "$1" -c "$2"', str(script), sys.executable, dump]
+    )
+    environ = json.loads(output.decode("utf-8"))
+    del expected["EXPORT-DASH"]
+    assert dict((name, environ.get(name)) for name in expected) == expected
+    assert "EXPORT_EMPTY" not in environ
+    assert "EXPORT-DASH" not in environ
+
+
+def test_export_json(run, exportenvdir, capfd):
+    path, expected = exportenvdir
+    exported = json.loads(export(run, capfd, str(path), "json"))
+    assert exported.pop("EXPORT_EMPTY") is None
+    assert exported == expected
+
+
+def test_export_null(run, exportenvdir, capfd):
+    path, expected = exportenvdir
+    output = export(run, capfd, str(path), "null")
+    assert output.endswith("\0")
+    exported = dict(pair.split("=", 1) for pair in output.split("\0")[:-1])
+    assert exported == expected
+
+
+def load_dotenv(output):
+    "Loads dotenv lines like Docker Compose, without expanding variables"
+    values = {}
+    for line in output.splitlines():
+        name, _, value = line.partition("=")
+        if value[0] == "'":
+            values[name] = value[1:-1]
+        else:
+            values[name] = re.sub(
+                r'\\([\\"n])|\$\$',
+                lambda match: {"n": "\n", None: "$"}.get(
+                    match.group(1), match.group(1)
+                ),
+                value[1:-1],
+            )
+    return values
+
+
+def test_export_dotenv(run, exportenvdir, capfd):
+    path, expected = exportenvdir
+    path.join("EXPORT_DOLLAR").write("$HOME ${HOME} `id` \\ \"")
+    expected["EXPORT_DOLLAR"] = "$HOME ${HOME} `id` \\ \""
+    output = export(run, capfd, str(path), "dotenv")
+    lines = output.splitlines()
+    assert len(lines) == len(expected)
+    assert 'EXPORT_NULL="multi\\nline\\n"' in lines
+    assert 'EXPORT_QUOTES="it\'s \\"quoted\\" $$HOME `id` \\\\ "' in lines
+    assert "EXPORT_DOLLAR='$HOME ${HOME} `id` \\ \"'" in lines
+    assert load_dotenv(output) == dict(
+        (name, value) for name, value in expected.items() if value is not None
+    )
+
+
+def test_export_usage(run, layers, capfd):
+    base, prod = layers
+    output = export(run, capfd, os.pathsep.join([str(base), str(prod)]), "json")
+    assert json.loads(output) == {
+        "LAYER_BASE": "base",
+        "LAYER_OVERRIDDEN": "prod",
+        "LAYER_PROD": "prod",
+        "LAYER_UNSET": None,
+    }
+
+    with py.test.raises(Response) as response:
+        run("envdir", "--export", str(base), "ls")
+    assert "incorrect number of arguments" in response.value.message
+
+    with py.test.raises(SystemExit):
+        run("envdir", "--export", "--format=xml", str(base))
+
+
+@pytest.fixture
+def daemon(tmpdir, monkeypatch):
+    if not hasattr(socket, "AF_UNIX"):
+        pytest.skip("Unix sockets required")
+    path = str(tmpdir.join("envdir.sock"))
+    monkeypatch.setenv("ENVDIR_SOCKET", path)
+    server = envdir.daemon.Server()
+    server.bind()
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    yield server
+    server.stop()
+    thread.join()
+    assert not os.path.exists(path)
+
+
+def test_daemon(run, daemon, layers, monkeypatch):
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    base, prod = layers
+    base.join("DAEMON_NULL").write("multi\x00line\n")
+    path = os.pathsep.join([str(base), str(prod)])
+    monkeypatch.setenv("LAYER_UNSET", "unset by the envdir")
+    with py.test.raises(Response) as response:
+        run("envdir", "--via-daemon", path, "ls")
+    assert response.value.status == 0
+    assert os.environ["LAYER_BASE"] == "base"
+    assert os.environ["LAYER_OVERRIDDEN"] == "prod"
+    assert os.environ["DAEMON_NULL"] == "multi\nline"
+    assert "LAYER_UNSET" not in os.environ
+
+    with envdir.Env([str(base), str(prod)]) as env:
+        expected = dict(env.data)
+    fetched = dict(envdir.daemon.fetch([str(base), str(prod)]))
+    assert fetched.pop("LAYER_UNSET") is None
+    assert fetched == expected
+
+    # changes are picked up
+    age_envdir(base)
+    age_envdir(prod)
+    assert dict(envdir.daemon.fetch([str(prod)]))["LAYER_PROD"] == "prod"
+    assert str(prod) in daemon.snapshots
+    prod.join("LAYER_PROD").write("changed")
+    assert dict(envdir.daemon.fetch([str(prod)]))["LAYER_PROD"] == "changed"
+
+    with py.test.raises(Response) as response:
+        run("envdir", "serve")
+    assert "already listening" in response.value.message
+
+    # sockets of other users are never asked
+    monkeypatch.setattr(os, "getuid", lambda: os.stat(daemon.path).st_uid + 1)
+    assert envdir.daemon.fetch([str(prod)]) is None
+    with py.test.raises(Response) as response:
+        run("envdir", "serve")
+    assert "not a socket owned by this user" in response.value.message
+
+
+def test_daemon_fallback(run, tmpenvdir, tmpdir, monkeypatch):
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    monkeypatch.setenv("ENVDIR_SOCKET", str(tmpdir.join("missing.sock")))
+    tmpenvdir.join("DAEMON_FALLBACK").write("direct")
+    assert envdir.daemon.fetch([str(tmpenvdir)]) is None
+    with py.test.raises(Response) as response:
+        run("envdir", "--via-daemon", str(tmpenvdir), "ls")
+    assert response.value.status == 0
+    assert os.environ["DAEMON_FALLBACK"] == "direct"
+
+    # a directory named like a subcommand is an envdir nonetheless
+    tmpdir.mkdir("serve").join("DAEMON_SERVE_DIR").write("dir")
+    monkeypatch.chdir(tmpdir)
+    with py.test.raises(Response) as response:
+        run("envdir", "serve", "ls")
+    assert os.environ["DAEMON_SERVE_DIR"] == "dir"
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="POSIX only")
+def test_spawn(tmpenvdir, monkeypatch):
+    tmpenvdir.join("SPAWN").write("spawned")
+    tmpenvdir.join("SPAWN_EMPTY").write("")
+    monkeypatch.setenv("SPAWN_EMPTY", "original")
+    with envdir.Env(str(tmpenvdir)) as env:
+        environ = env.as_exec_env()
+        assert environ["SPAWN"] == "spawned"
+        assert "SPAWN_EMPTY" not in environ
+        assert env.as_exec_env() is environ
+        with py.test.raises(TypeError):
+            environ["SPAWN"] = "changed"
+
+        check = (
+            "import os, sys; " "sys.exit(os.environ['SPAWN'] == 'spawned' and 7 or 1)"
+        )
+        putenv = []
+        original_putenv = os.putenv
+        monkeypatch.setattr(os, "putenv", lambda *args: putenv.append(args))
+        pid = env.spawn([sys.executable, "-c", check])
+        assert os.WEXITSTATUS(os.waitpid(pid, 0)[1]) == 7
+        pid = env.spawn(["sh", "-c", 'test "$SPAWN" = spawned && exit 8'])
+        assert os.WEXITSTATUS(os.waitpid(pid, 0)[1]) == 8
+        assert putenv == []
+        with py.test.raises(OSError):
+            env.spawn(["envdir-does-not-exist"])
+        monkeypatch.setattr(os, "putenv", original_putenv)
+
+        env["SPAWN"] = "changed"
+        assert env.as_exec_env() is not environ
+        assert env.as_exec_env()["SPAWN"] == "changed"
+
+
+def test_refresh_removed_while_listing(tmpenvdir, monkeypatch):
+    tmpenvdir.join("REFRESH_REMOVED").write("removed")
+    with envdir.Env(str(tmpenvdir)) as env:
+        scandir = envdir.env._scandir
+
+        def racing_scandir(path):
+            entries = list(scandir(path))
+            tmpenvdir.join("REFRESH_REMOVED").remove()
+            return entries
+
+        monkeypatch.setattr(envdir.env, "_scandir", racing_scandir)
+        assert env.refresh() == [("REFRESH_REMOVED", "removed", None)]
+        assert "REFRESH_REMOVED" not in os.environ
+
+
+def test_read_only(layers, monkeypatch):
+    base, prod = layers
+    base.join("READ_ONLY_NULL").write("multi\x00line\n")
+    monkeypatch.setenv("LAYER_UNSET", "original")
+    environ = dict(os.environ)
+    env = envdir.read_only([str(base), str(prod)])
+    assert dict(os.environ) == environ
+    with envdir.Env([str(base), str(prod)]) as expected:
+        assert dict(env) == expected.data
+    assert env["READ_ONLY_NULL"] == "multi\nline"
+    assert "LAYER_UNSET" not in env
+    assert list(env) == sorted(env)
+    assert env.path == str(prod)
+    with py.test.raises(KeyError):
+        env["LAYER_MISSING"]
+    with py.test.raises(TypeError):
+        env["LAYER_BASE"] = "changed"
+    with py.test.raises(AttributeError):
+        env.changed = True
+    assert not hasattr(env, "__dict__")
+
+
+def test_apply_false(tmpenvdir, monkeypatch):
+    tmpenvdir.join("APPLY_FALSE").write("envdir")
+    tmpenvdir.join("APPLY_FALSE_EMPTY").write("")
+    monkeypatch.setenv("APPLY_FALSE", "original")
+    monkeypatch.setenv("APPLY_FALSE_EMPTY", "original")
+    environ = dict(os.environ)
+    with envdir.Env(str(tmpenvdir), apply=False) as env:
+        assert env["APPLY_FALSE"] == "envdir"
+        env["APPLY_FALSE_WRITTEN"] = "written"
+        assert tmpenvdir.join("APPLY_FALSE_WRITTEN").read() == "written"
+        assert env.originals == {}
+        assert dict(os.environ) == environ
+        exec_env = env.as_exec_env()
+        assert exec_env["APPLY_FALSE"] == "envdir"
+        assert exec_env["APPLY_FALSE_WRITTEN"] == "written"
+        assert "APPLY_FALSE_EMPTY" not in exec_env
+    assert dict(os.environ) == environ
+
+
+@pytest.mark.skipif(not hasattr(os, "environb"), reason="os.environb only")
+def test_binary(run, tmpenvdir, monkeypatch):
+    tmpenvdir.join("BINARY").write_binary(b"caf\xe9\x00latin-1\n")
+    tmpenvdir.join("BINARY_EMPTY").write("")
+    monkeypatch.setenv("BINARY_EMPTY", "original")
+    with envdir.Env(str(tmpenvdir), binary=True) as env:
+        assert env["BINARY"] == b"caf\xe9\nlatin-1"
+        assert os.environb[b"BINARY"] == b"caf\xe9\nlatin-1"
+        assert b"BINARY_EMPTY" not in os.environb
+        assert env.as_exec_env()[b"BINARY"] == b"caf\xe9\nlatin-1"
+        env["BINARY_WRITTEN"] = b"\xff"
+        assert tmpenvdir.join("BINARY_WRITTEN").read_binary() == b"\xff"
+        assert os.environb[b"BINARY_WRITTEN"] == b"\xff"
+    assert b"BINARY" not in os.environb
+    assert os.environ["BINARY_EMPTY"] == "original"
+
+    monkeypatch.setenv("ENVDIR_CACHE", "1")
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    with py.test.raises(Response) as response:
+        run("envdir", "--binary", str(tmpenvdir), "true")
+    assert response.value.status == 0
+    assert os.environb[b"BINARY"] == b"caf\xe9\nlatin-1"
+    del os.environ["BINARY"]
+    del os.environ["BINARY_WRITTEN"]
+
+
+def test_overlay(tmpenvdir, monkeypatch):
+    tmpenvdir.join("OVERLAY_SET").write("envdir")
+    tmpenvdir.join("OVERLAY_EMPTY").write("")
+    monkeypatch.setenv("OVERLAY_SET", "original")
+    monkeypatch.setenv("OVERLAY_EMPTY", "original")
+    monkeypatch.delenv("OVERLAY_NEW", raising=False)
+    environ = dict(os.environ)
+    env = envdir.Env(str(tmpenvdir), apply=False)
+
+    with env.overlay() as outer:
+        assert os.environ["OVERLAY_SET"] == "envdir"
+        assert "OVERLAY_EMPTY" not in os.environ
+        # only its own changes are recorded
+        inner = env.overlay(OVERLAY_NEW="inner").push()
+        assert inner.saved == {"OVERLAY_NEW": None}
+        innermost = envdir.Overlay(OVERLAY_SET="innermost").push()
+        assert innermost.saved == {"OVERLAY_SET": "envdir"}
+        assert os.environ["OVERLAY_SET"] == "innermost"
+        # popping an overlay pops the ones pushed after it first
+        inner.pop()
+        assert innermost.saved is None
+        assert os.environ["OVERLAY_SET"] == "envdir"
+        assert "OVERLAY_NEW" not in os.environ
+        with pytest.raises(ValueError):
+            inner.pop()
+        assert outer.saved == {"OVERLAY_SET": "original", "OVERLAY_EMPTY": "original"}
+    assert dict(os.environ) == environ
+
+    # empty files unsetting a variable of the outer environment
+    with envdir.Env(str(tmpenvdir)) as env:
+        assert "OVERLAY_EMPTY" not in os.environ
+    assert os.environ["OVERLAY_EMPTY"] == "original"
+
+
+def test_pytest_plugin(tmpdir):
+    tmpdir.mkdir("envdir").join("PLUGIN_VALUE").write("envdir")
+    tmpdir.join("test_plugin.py").write("""
+import os
+
+def test_environ(envdir_environ):
+    assert os.environ["PLUGIN_VALUE"] == "envdir"
+    envdir_environ(PLUGIN_VALUE="changed", PLUGIN_OTHER="other")
+    assert os.environ["PLUGIN_VALUE"] == "changed"
+
+def test_restored():
+    assert "PLUGIN_VALUE" not in os.environ
+    assert "PLUGIN_OTHER" not in os.environ
+""")
+    environ = dict(os.environ)
+    environ.pop("PLUGIN_VALUE", None)
+    # only loaded with -p
+    environ["PYTEST_DISABLE_PLUGIN_AUTOLOAD"] = "1"
+    environ["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(envdir.__file__))]
+        + environ.get("PYTHONPATH", "").split(os.pathsep)
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "pytest",
+            "-p",
+            "envdir.pytest_plugin",
+            "-p",
+            "no:cacheprovider",
+            "-q",
+            "test_plugin.py",
+        ],
+        cwd=str(tmpdir),
+        env=environ,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = process.communicate()[0].decode()
+    assert process.returncode == 0, output
+    assert "2 passed" in output
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_scan(tmpdir, monkeypatch, workers):
+    monkeypatch.setattr(envdir.env, "_encoding", lambda: "utf-8")
+    paths = []
+    for index in range(20):
+        path = tmpdir.mkdir("scan%d" % index)
+        path.join("SCAN_INDEX").write("%d\n" % index)
+        path.join("SCAN_NULL").write("multi\x00line")
+        path.join("SCAN_EMPTY").write("")
+        paths.append(str(path))
+    tmpdir.mkdir("scan-latin1").join("SCAN_LATIN1").write_binary(b"caf\xe9")
+    tmpdir.join("scan-file").write("not an envdir")
+    failing = [
+        str(tmpdir.join("scan-missing")),
+        str(tmpdir.join("scan-latin1")),
+        str(tmpdir.join("scan-file")),
+    ]
+    paths.extend(failing)
+    consumed = []
+
+    def generate():
+        for path in paths:
+            consumed.append(path)
+            yield path
+
+    environ = dict(os.environ)
+    results = envdir.scan(generate(), workers=workers)
+    first = next(results)
+    assert len(consumed) <= max(workers * 2, 1)
+    results = dict((result.path, result) for result in [first] + list(results))
+    assert dict(os.environ) == environ
+    assert sorted(results) == sorted(paths)
+
+    missing = results.pop(failing[0])
+    assert missing.env is None
+    assert isinstance(missing.error, EnvironmentError)
+    assert "failed" in repr(missing)
+    # one bad envdir doesn't stop the scan
+    assert isinstance(results.pop(failing[1]).error, UnicodeDecodeError)
+    assert isinstance(results.pop(failing[2]).error, ValueError)
+    for index, path in enumerate(paths[: -len(failing)]):
+        result = results[path]
+        assert result.error is None
+        assert result.seconds >= 0
+        assert dict(result.env) == {
+            "SCAN_INDEX": str(index),
+            "SCAN_NULL": "multi\nline",
+        }
+
+
+def test_fingerprint(run, tmpenvdir, capfd):
+    tmpenvdir.join("FINGERPRINT").write("value\n")
+    tmpenvdir.join("FINGERPRINT_NULL").write("multi\x00line")
+    tmpenvdir.join("FINGERPRINT_EMPTY").write("")
+    with envdir.Env(str(tmpenvdir)) as env:
+        fingerprint = env.fingerprint()
+        assert len(fingerprint) == 64
+        assert fingerprint == envdir.env.digest([str(tmpenvdir)])
+        with py.test.raises(Response) as response:
+            run("envdir", "--fingerprint", str(tmpenvdir))
+        assert response.value.status == 0
+        assert capfd.readouterr()[0] == fingerprint + "\n"
+
+        # kept up to date incrementally
+        age_envdir(tmpenvdir)
+        tmpenvdir.join("FINGERPRINT").write("changed")
+        tmpenvdir.join("FINGERPRINT_NULL").remove()
+        tmpenvdir.join("FINGERPRINT_EMPTY").write("set")
+        tmpenvdir.join("FINGERPRINT_NEW").write("")
+        assert len(env.refresh()) == 3
+        changed = envdir.env.digest([str(tmpenvdir)])
+        assert changed != fingerprint
+        assert env.fingerprint() == changed
+        env["FINGERPRINT_SET"] = "set"
+        del env["FINGERPRINT_SET"]
+        assert env.fingerprint() == changed
+        assert envdir.Env(str(tmpenvdir), apply=False).fingerprint() == changed
+
+        # the fast mode only looks at the stats
+        fast = env.fingerprint(fast=True)
+        assert fast != changed
+        assert envdir.env.digest([str(tmpenvdir)], fast=True) == fast
+        with py.test.raises(Response) as response:
+            run("envdir", "--fingerprint", "--fast", str(tmpenvdir))
+        assert capfd.readouterr()[0] == fast + "\n"
+        os.utime(str(tmpenvdir.join("FINGERPRINT")), (0, 0))
+        assert env.fingerprint(fast=True) != fast
+        assert env.fingerprint() == changed
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"\n\nleading and trailing\n\n\n",
+        b"null\x00separated\x00lines\x00\n",
+        b"windows\r\nnewlines\r\n",
+        b"\n\n\n",
+        b"unicode \xc3\xa9t\xc3\xa9\n",
+    ],
+)
+def test_mmap(tmpenvdir, monkeypatch, content):
+    tmpenvdir.join("MMAP").write_binary(content * 1000)
+    _, data = envdir.env._read(str(tmpenvdir.join("MMAP")))
+    assert isinstance(data, bytes)
+    expected = envdir.env._decode(data, "utf-8")
+
+    monkeypatch.setattr(envdir.env, "MMAP_THRESHOLD", 1)
+    _, mapped = envdir.env._read(str(tmpenvdir.join("MMAP")))
+    assert not isinstance(mapped, bytes)
+    assert envdir.env._decode(mapped, "utf-8") == expected
+    assert mapped.closed
+    _, mapped = envdir.env._read(str(tmpenvdir.join("MMAP")))
+    # not ASCII compatible, decoded like small files
+    assert envdir.env._decode(mapped, "cp037") == envdir.env._decode(data, "cp037")
+
+    with envdir.Env(str(tmpenvdir)) as env:
+        assert env.data["MMAP"] == expected
+
+
+def test_trace(tmpenvdir, tmpdir, run, monkeypatch, capfd):
+    tmpenvdir.join("TRACE").write("traced")
+    tmpenvdir.join("TRACE_EMPTY").write("")
+    with envdir.Env(str(tmpenvdir)) as env:
+        assert env.stats is None
+    with envdir.Env(str(tmpenvdir), trace=True) as env:
+        stats = env.stats
+    assert stats["mode"] == "scan"
+    assert set(stats["phases"]) == set(["list", "read", "decode", "apply"])
+    assert sum(stats["phases"].values()) == pytest.approx(stats["seconds"])
+    assert stats["syscalls"] == {
+        "scandir": 1,
+        "open": 2,
+        "fstat": 2,
+        "read": 1,
+        "close": 2,
+        "putenv": 1,
+    }
+    assert sorted(file["name"] for file in stats["files"]) == ["TRACE", "TRACE_EMPTY"]
+    with envdir.Env(str(tmpenvdir), trace=True, lazy=True) as env:
+        assert env.stats["mode"] == "lazy"
+        assert env.stats["files"] == []
+
+    monkeypatch.setattr(os, "execvpe", functools.partial(mocked_execvpe, monkeypatch))
+    with py.test.raises(Response):
+        run("envdir", "--trace", str(tmpenvdir), "ls")
+    events = [json.loads(line) for line in capfd.readouterr()[1].splitlines()]
+    assert [event["event"] for event in events] == ["file", "file", "load", "exec"]
+    assert events[2]["syscalls"]["open"] == 2
+    assert events[3]["command"] == "ls"
+
+    trace = tmpdir.join("trace.jsonl")
+    monkeypatch.setenv("ENVDIR_TRACE", str(trace))
+    with py.test.raises(Response):
+        run("envdir", str(tmpenvdir), "ls")
+    assert capfd.readouterr()[1] == ""
+    assert len(trace.readlines()) == 4
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_typed(tmpenvdir, monkeypatch, lazy):
+    tmpenvdir.join("TYPED_INT").write("42\n")
+    tmpenvdir.join("TYPED_BOOL").write("Yes")
+    tmpenvdir.join("TYPED_LIST").write("a, b ,c")
+    tmpenvdir.join("TYPED_JSON").write('{"key": [1, 2]}')
+    tmpenvdir.join("TYPED_URL").write("postgres://user@localhost:5432/db")
+    tmpenvdir.join("TYPED_INVALID").write("many")
+    with envdir.Env(str(tmpenvdir), lazy=lazy) as env:
+        assert env.get_int("TYPED_INT") == 42
+        assert env.get_bool("TYPED_BOOL") is True
+        assert env.get_list("TYPED_LIST") == ("a", "b", "c")
+        assert env.get_list("TYPED_LIST", sep=" ") == ("a,", "b", ",c")
+        assert env.get_json("TYPED_JSON") == {"key": [1, 2]}
+        url = env.get_url("TYPED_URL")
+        assert (url.scheme, url.hostname, url.port) == ("postgres", "localhost", 5432)
+        assert env.get_int("TYPED_MISSING", None) is None
+        with py.test.raises(KeyError):
+            env.get_int("TYPED_MISSING")
+        with py.test.raises(ValueError) as error:
+            env.get_int("TYPED_INVALID")
+        assert "TYPED_INVALID" in str(error.value)
+        with py.test.raises(ValueError):
+            env.get_bool("TYPED_INVALID")
+
+        # parsed once
+        assert env.get_json("TYPED_JSON") is env.get_json("TYPED_JSON")
+        monkeypatch.setattr(envdir.env, "_parse_bool", None)
+        assert env.get_bool("TYPED_BOOL") is True
+        monkeypatch.undo()
+
+        # until changed
+        env["TYPED_INT"] = "43"
+        assert env.get_int("TYPED_INT") == 43
+        age_envdir(tmpenvdir)
+        tmpenvdir.join("TYPED_BOOL").write("off")
+        env.refresh()
+        assert env.get_bool("TYPED_BOOL") is False
+        del env["TYPED_INT"]
+        assert env.get_int("TYPED_INT", 0) == 0
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_pack(tmpdir, run, capfd, monkeypatch, lazy):
+    path = tmpdir.mkdir("packed")
+    path.join("PACK_SMALL").write("small\n")
+    path.join("PACK_NULL").write_binary(b"null\x00separated\n")
+    path.join("PACK_CRLF").write_binary(b"windows\r\nnewlines\r\n")
+    path.join("PACK_NEWLINE").write("\n")
+    path.join("PACK_EMPTY").write("")
+    path.join("PACK_LARGE").write("large" * 20000)
+    for index in range(100):
+        path.join("PACK_%03d" % index).write("value %d" % index)
+    monkeypatch.setenv("PACK_EMPTY", "original")
+    packed = str(tmpdir.join("env.pack"))
+
+    with py.test.raises(Response) as response:
+        run("envdir", "pack", str(path), "-o", packed)
+    assert response.value.status == 0
+    with envdir.Env(str(path), apply=False) as expected:
+        expected_data = dict(expected.data)
+
+    opened = []
+    original_open = os.open
+
+    def counting_open(path, *args, **kwargs):
+        opened.append(path)
+        return original_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "open", counting_open)
+    with envdir.Env(packed, lazy=lazy) as env:
+        assert opened == []
+        assert env["PACK_SMALL"] == "small"
+        assert env["PACK_050"] == "value 50"
+        assert "PACK_MISSING" not in env
+        assert dict(env.apply().data) == expected_data
+        assert os.environ["PACK_NULL"] == "null\nseparated"
+        assert "PACK_EMPTY" not in os.environ
+        with py.test.raises(ValueError):
+            env["PACK_WRITE"] = "written"
+    assert os.environ["PACK_EMPTY"] == "original"
+    monkeypatch.setattr(os, "open", original_open)
+
+    with envdir.Env(packed, apply=False) as env:
+        path.join("PACK_SMALL").write("changed")
+        path.join("PACK_000").remove()
+        assert env.refresh() == []
+        envdir.pack.pack(str(path), packed)
+        assert sorted(env.refresh()) == [
+            ("PACK_000", "value 0", None),
+            ("PACK_SMALL", "small", "changed"),
+        ]
+    assert dict(envdir.read_only(packed)) == dict(envdir.read_only(str(path)))
+
+    with py.test.raises(Response) as response:
+        run("envdir", "unpack", packed, "-o", str(tmpdir.join("unpacked")))
+    assert response.value.status == 0
+    for name in os.listdir(str(path)):
+        assert tmpdir.join("unpacked", name).read_binary() == (
+            path.join(name).read_binary()
+        )
+
+    with py.test.raises(Response) as response:
+        run("envdir", "pack", str(path))
+    assert response.value.status == 2
+    with py.test.raises(Response) as response:
+        run("envdir", str(tmpdir.join("unpacked", "PACK_SMALL")), "ls")
+    assert response.value.status == 111
+    with py.test.raises(Response) as response:
+        run("envdir", os.pathsep.join([packed, str(path)]), "ls")
+    assert response.value.status == 111
+    assert "can't be layered" in str(response.value)
+
+    env = envdir.Env(packed, apply=False)
+    env.clear()
+    assert env._pack._buf.closed
+    truncated = tmpdir.join("truncated.pack")
+    truncated.write_binary(tmpdir.join("env.pack").read_binary()[:-1])
+    with py.test.raises(ValueError) as error:
+        envdir.Env(str(truncated))
+    assert "truncated" in str(error.value)
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="No symlinks")
+def test_pack_not_a_directory(tmpenvdir, tmpdir):
+    "Envdirs with variables failing with ENOTDIR aren't taken for packs"
+    tmpdir.join("file").write("file")
+    tmpenvdir.join("BROKEN").mksymlinkto(tmpdir.join("file", "below"))
+    with py.test.raises(EnvironmentError) as error:
+        envdir.Env(str(tmpenvdir))
+    assert error.value.errno == errno.ENOTDIR
+    assert error.value.filename == str(tmpenvdir.join("BROKEN"))
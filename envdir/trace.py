@@ -0,0 +1,168 @@
+"""
+Timings and system call counts of loading envdirs and running children,
+enabled with ``ENVDIR_TRACE``, ``envdir --trace`` or ``Env(path,
+trace=True)``, see :attr:`envdir.Env.stats`.
+"""
+
+import json
+import os
+import sys
+import time
+
+from .env import _decode, _encoding, _read
+
+try:
+    perf_counter = time.perf_counter
+except AttributeError:  # <python3.3
+    perf_counter = time.time
+
+
+class Tracer(object):
+    """
+    Records the time spent in the phases of loading an envdir (listing,
+    reading and decoding the files and applying the variables), the time
+    spent reading every single file and the number of system calls done,
+    and writes them as JSON lines to the given stream, if any.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.started = perf_counter()
+        self.mode = None
+        self.seconds = 0.0
+        self.phases = {}
+        self.syscalls = {}
+        # dicts of the name, path, size, read and decode time of the files
+        self.files = []
+
+    @classmethod
+    def from_environ(cls, value):
+        """
+        The Tracer for the value of ``ENVDIR_TRACE``: None if it's empty or
+        false, writing to stderr if it's true and appending to the file of
+        that name otherwise.
+        """
+        if value.lower() in ("", "0", "false", "no"):
+            return None
+        if value.lower() in ("1", "true", "yes"):
+            return cls(sys.stderr)
+        return cls(open(value, "a"))
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, syscall, number=1):
+        self.syscalls[syscall] = self.syscalls.get(syscall, 0) + number
+
+    def emit(self, event, **fields):
+        if self.stream is None:
+            return
+        fields["event"] = event
+        self.stream.write(json.dumps(fields, sort_keys=True) + "\n")
+        self.stream.flush()
+
+    def timed_read(self, path):
+        start = perf_counter()
+        stat, data = _read(path)
+        return stat, data, perf_counter() - start
+
+    def read_entries(self, entries, workers=1, binary=False):
+        """
+        Like :func:`envdir.env._read_entries`, timing the listing of the
+        entries, the reading and the decoding of every file.
+        """
+        encoding = None if binary else _encoding()
+        start = perf_counter()
+        entries = list(entries)
+        self.add("list", perf_counter() - start)
+        if workers > 1:
+            start = perf_counter()
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(
+                    pool.map(self.timed_read, [entry.path for entry in entries])
+                )
+                self.add("read", perf_counter() - start)
+        else:
+            results = (self.timed_read(entry.path) for entry in entries)
+        for entry, (stat, data, read) in zip(entries, results):
+            if workers <= 1:
+                self.add("read", read)
+            self.count("open")
+            self.count("fstat")
+            if stat.st_size:
+                self.count("read" if isinstance(data, bytes) else "mmap")
+            self.count("close")
+            start = perf_counter()
+            value = _decode(data, encoding) if data else None
+            decode = perf_counter() - start
+            self.add("decode", decode)
+            self.files.append(
+                {
+                    "name": entry.name,
+                    "path": entry.path,
+                    "size": stat.st_size,
+                    "read": read,
+                    "decode": decode,
+                }
+            )
+            yield entry.name, stat, value
+
+    def load(self, env, load):
+        """
+        Calls load, the loader of env, and records the time it took.
+        """
+        if env._pack is not None:
+            self.mode = "pack"
+        elif env.lazy and not env.cache:
+            self.mode = "lazy"
+        else:
+            self.mode = "cache" if env.cache else "scan"
+        start = perf_counter()
+        load()
+        self.seconds = perf_counter() - start
+        if self.mode == "pack":
+            self.count("open")
+            self.count("mmap")
+        elif self.mode != "cache":
+            self.count("scandir", len(env.paths))
+        if self.mode == "lazy":
+            self.count("stat", len(env._pending))
+            self.add("list", self.seconds)
+        elif self.mode in ("cache", "pack"):
+            # reading the snapshot (or pack) and applying the variables
+            self.add(self.mode, self.seconds)
+        else:
+            if env._apply:
+                self.count("putenv", len(env.data))
+            # whatever wasn't spent listing, reading and decoding
+            self.add("apply", max(self.seconds - sum(self.phases.values()), 0.0))
+        # not while loading, to not count writing them
+        for file in self.files:
+            self.emit("file", **file)
+        self.emit(
+            "load",
+            path=os.pathsep.join(env.paths),
+            mode=self.mode,
+            seconds=self.seconds,
+            variables=len(env),
+            phases=self.phases,
+            syscalls=self.syscalls,
+        )
+
+    def execute(self, command):
+        """
+        Records that the command is about to be executed, with the time
+        since the Tracer was created, e.g. the startup time of envdir.
+        """
+        self.emit("exec", command=command, seconds=perf_counter() - self.started)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "seconds": self.seconds,
+            "phases": dict(self.phases),
+            "syscalls": dict(self.syscalls),
+            "files": list(self.files),
+        }
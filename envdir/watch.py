@@ -0,0 +1,193 @@
+"""
+Live reloading of envdirs, see :meth:`envdir.Env.watch`.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+
+from .env import _fsdecode, _fsencode
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# regular files are reread once they are closed after writing, not on
+# every single write (or their creation) to not see partial content
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+_event = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """
+    A minimal ctypes based binding of Linux' inotify API.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        except OSError:
+            return False
+        return hasattr(libc, "inotify_init1")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, _fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for events and returns them as a list
+        of (watch descriptor, mask, name) tuples.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _event.unpack_from(buf, offset)
+            offset += _event.size
+            end = offset + length
+            name = buf[offset:end].rstrip(b"\0")
+            offset = end
+            events.append((wd, mask, _fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(threading.Thread):
+    """
+    A daemon thread applying changes to the files of an envdir to its
+    :class:`~envdir.Env` as they happen, see :meth:`envdir.Env.watch`.
+    """
+
+    def __init__(self, env, interval=1.0):
+        super(Watcher, self).__init__(name="envdir-watcher %s" % env.path)
+        self.daemon = True
+        self.env = env
+        self.interval = interval
+        self.callbacks = []
+        self.stopped = threading.Event()
+        self.inotify = None
+        # the watched envdirs, mapped to their watch descriptors
+        self.watches = {}
+        if Inotify.available():
+            try:
+                self.inotify = Inotify()
+                for path in env.paths:
+                    self.watches[self.inotify.add_watch(path)] = path
+            except OSError:
+                # e.g. out of inotify instances (EMFILE) or watches
+                # (ENOSPC), polling works nonetheless
+                if self.inotify is not None:
+                    self.inotify.close()
+                self.inotify = None
+                self.watches = {}
+
+    def run(self):
+        try:
+            if self.inotify is None:
+                self.poll()
+            else:
+                self.listen()
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def notify(self, changes):
+        for name, old, new in changes:
+            for callback in self.callbacks:
+                callback(self.env, name, old, new)
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            self.notify(self.env.refresh())
+
+    def listen(self):
+        # catch up with changes between loading the envdir and watching it
+        self.notify(self.env.refresh())
+        while not self.stopped.is_set():
+            names = set()
+            rescan = False
+            for wd, mask, name in self.inotify.read(self.interval):
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    # the envdir itself is gone
+                    return
+                if mask & IN_ISDIR and name.startswith(".envdir-"):
+                    # staging directory of Env._write
+                    continue
+                if mask & IN_Q_OVERFLOW or mask & IN_ISDIR:
+                    # lost events or e.g. a swapped ..data directory
+                    # symlink as used by Kubernetes
+                    rescan = True
+                elif mask & IN_CREATE and not os.path.islink(
+                    os.path.join(self.watches[wd], name)
+                ):
+                    # new regular files are read once closed
+                    continue
+                elif name:
+                    names.add((self.watches[wd], name))
+            if rescan:
+                self.notify(self.env.refresh())
+                continue
+            changes = []
+            reloaded = set()
+            for path, name in sorted(names):
+                if os.path.isdir(os.path.join(path, name)):
+                    # symlinks to directories are no variables, but can
+                    # be the targets of the symlinks which are
+                    changes.extend(self.env.refresh())
+                    break
+                if "=" in name or name in reloaded:
+                    continue
+                reloaded.add(name)
+                old, new = self.env._reload(name)
+                if old != new:
+                    changes.append((name, old, new))
+            self.notify(changes)